@@ -2,7 +2,9 @@
 namespace App\Controllers;
 
 use FastSitePHP\Application;
+use FastSitePHP\Web\Response;
 use App\Models\WebServiceResult;
+use App\Middleware\Databases;
 
 /**
  * Controller that queries a SQLite database of Geonames Data.
@@ -12,13 +14,49 @@ use App\Models\WebServiceResult;
  * one of the following scripts:
  *     app_data/scripts/geonames.py
  *     app_data/scripts/geonames.rb
+ *
+ * Countries, regions, and cities are returned from static JSON snapshots
+ * when they have been created by [geonames.py] with [CREATE_SNAPSHOTS = True].
  */
 class Geonames
 {
+    /**
+     * Geonames feature classes (http://www.geonames.org/export/codes.html),
+     * an empty [feature_class] matches all places.
+     */
+    const FEATURE_CLASSES = ['A', 'H', 'L', 'P', 'R', 'S', 'T', 'U', 'V'];
+
+    /**
+     * The [nearby()] search box starts at 25 km and grows 4 times larger
+     * until enough places are found or the box reaches this size.
+     */
+    const NEARBY_MAX_KM = 400;
+
+    /**
+     * Columns of the [geonames] table in the original layout from [scripts/geonames.py],
+     * [getPlace()] returns columns in this order for both the original and compact layout.
+     */
+    const PLACE_COLUMNS = [
+        'geonames_id', 'name', 'ascii_name', 'alternate_names', 'latitude', 'longitude',
+        'feature_class', 'feature_code', 'country_code', 'cc2', 'admin1_code', 'admin2_code',
+        'admin3_code', 'admin4_code', 'population', 'elevation', 'dem', 'timezone', 'modification_date',
+    ];
+
+    /**
+     * ETags of snapshot files read from [manifest.json], keyed by the
+     * manifest path and modified time, see [snapshotEtag()].
+     */
+    private static $snapshot_etags = [];
+
     public function getCountries(Application $app)
     {
+        $by_country = (isset($_GET['order_by']) && $_GET['order_by'] === 'country');
+        $snapshot = $this->snapshot($app, ($by_country ? 'countries-by-country' : 'countries'));
+        if ($snapshot !== null) {
+            return $snapshot;
+        }
         $sql = $app->getSql('geonames-countries.sql');
-        if (isset($_GET['order_by']) && $_GET['order_by'] === 'country') {
+        if ($by_country) {
             $sql = str_replace('population DESC,', '', $sql);
         }
         $records = $app->geonames->query($sql);
@@ -27,6 +65,10 @@ class Geonames
 
     public function getRegions(Application $app, $country)
     {
+        $snapshot = $this->snapshot($app, 'regions/' . $country);
+        if ($snapshot !== null) {
+            return $snapshot;
+        }
         $sql = $app->getSql('geonames-admin1-by-country.sql');
         $records = $app->geonames->query($sql, [$country]);
         return ['regions' => $records];
@@ -34,6 +76,10 @@ class Geonames
 
     public function getCities(Application $app, $country, $region)
     {
+        $snapshot = $this->snapshot($app, 'cities/' . $country . '/' . $region);
+        if ($snapshot !== null) {
+            return $snapshot;
+        }
         $sql = $app->getSql('geonames-20-largest-cities-in-admin1.sql');
         $records = $app->geonames->query($sql, [$country, $region]);
         return ['cities' => $records];
@@ -43,6 +89,12 @@ class Geonames
     {
         $sql = 'SELECT * FROM geonames WHERE geonames_id = ?';
         $record = $app->geonames->queryOne($sql, [$id]);
+        if ($record !== null && !array_key_exists('alternate_names', $record)) {
+            // Compact schema from [scripts/geonames.py] saves names in a separate table
+            $sql = 'SELECT alternate_names FROM geonames_alternate_names WHERE geonames_id = ?';
+            $record['alternate_names'] = $app->geonames->queryValue($sql, [$id]) ?? '';
+            $record = array_merge(array_flip(self::PLACE_COLUMNS), $record);
+        }
         if ($record['alternate_names']) {
             $record['alternate_names'] = explode(',', $record['alternate_names']);
         }
@@ -63,4 +115,223 @@ class Geonames
         $records = $app->geonames->query($sql, [':country_code'=>trim($country), ':name'=>trim($city)]);
         return ['cities' => $records];
     }
+
+    /**
+     * Autocomplete search that matches the start of each word in place names
+     * and alternate names and ignores accents. Results are sorted by population.
+     * Requires the full-text search index from [scripts/geonames.py].
+     */
+    public function searchPrefix(Application $app)
+    {
+        // Query String Params
+        $country = $_GET['country'] ?? '';
+        $city = $_GET['city'] ?? '';
+        $query = $this->searchPrefixQuery($city, $country);
+        if ($query === null) {
+            return WebServiceResult::error('[City] is a required search option.');
+        }
+
+        // Query Db
+        $sql = $app->getSql('geonames-search-prefix.sql');
+        $records = $app->geonames->query($sql, [':query'=>$query]);
+        return ['cities' => $records];
+    }
+
+    /**
+     * Nearest places to a point [lat, lon] with an optional [feature_class]
+     * and [limit] (1 to 100, default 20). Places are found using the R*Tree
+     * index from [scripts/geonames.py] by searching a box around the point
+     * that starts at 25 km and grows until enough places are found. The box
+     * stops growing at [NEARBY_MAX_KM] and places found within it are
+     * returned even if there are fewer than [limit].
+     */
+    public function nearby(Application $app)
+    {
+        // Query String Params
+        $lat = filter_var($_GET['lat'] ?? null, FILTER_VALIDATE_FLOAT);
+        $lon = filter_var($_GET['lon'] ?? null, FILTER_VALIDATE_FLOAT);
+        if ($lat === false || $lon === false || abs($lat) > 90 || abs($lon) > 180) {
+            return WebServiceResult::error('[Lat] and [Lon] are required search options.');
+        }
+        $limit = min(max((int)($_GET['limit'] ?? 20), 1), 100);
+        $feature_class = trim($_GET['feature_class'] ?? '');
+        if (!$this->isFeatureClass($feature_class)) {
+            return WebServiceResult::error('[feature_class] must be one of: ' . implode(', ', self::FEATURE_CLASSES));
+        }
+
+        // Query Db. Places in the corners of the box can be further away than
+        // places just outside of it so only places within [$radius] are kept.
+        $sql = $app->getSql('geonames-nearby.sql');
+        for ($radius = 25; ; $radius = min($radius * 4, self::NEARBY_MAX_KM)) {
+            $params = $this->distanceParams($lat, $lon, $radius);
+            $params[':latitude'] = $lat;
+            $params[':longitude'] = $lon;
+            $params[':feature_class'] = $feature_class;
+            $params[':limit'] = $limit;
+            $records = $this->withDistance($app->geonames->query($sql, $params));
+            $records = array_values(array_filter($records, function($record) use ($radius) {
+                return $record['distance_km'] <= $radius;
+            }));
+            if (count($records) === $limit || $radius >= self::NEARBY_MAX_KM) {
+                return ['places' => $records];
+            }
+        }
+    }
+
+    /**
+     * Up to 100 places inside a box [min_lat, max_lat, min_lon, max_lon]
+     * with an optional [feature_class], closest to the center of the box first.
+     * Boxes that cross the 180th meridian are not supported.
+     */
+    public function boundingBox(Application $app)
+    {
+        // Query String Params
+        $params = [];
+        foreach (['min_lat', 'max_lat', 'min_lon', 'max_lon'] as $name) {
+            $params[':' . $name] = filter_var($_GET[$name] ?? null, FILTER_VALIDATE_FLOAT);
+            if ($params[':' . $name] === false) {
+                return WebServiceResult::error('[min_lat], [max_lat], [min_lon], and [max_lon] are required search options.');
+            }
+        }
+        $params[':lon_scale'] = cos(deg2rad(($params[':min_lat'] + $params[':max_lat']) / 2));
+        $params[':feature_class'] = trim($_GET['feature_class'] ?? '');
+        if (!$this->isFeatureClass($params[':feature_class'])) {
+            return WebServiceResult::error('[feature_class] must be one of: ' . implode(', ', self::FEATURE_CLASSES));
+        }
+
+        // Query Db
+        $sql = $app->getSql('geonames-bounding-box.sql');
+        $records = $this->withDistance($app->geonames->query($sql, $params));
+        return ['places' => $records];
+    }
+
+    /**
+     * Return [true] if [$feature_class] is empty or a Geonames feature class
+     */
+    private function isFeatureClass($feature_class)
+    {
+        return ($feature_class === '' || in_array($feature_class, self::FEATURE_CLASSES, true));
+    }
+
+    /**
+     * Box of [$radius_km] around a point and the longitude scale used by the
+     * distance calculation in [geonames-nearby.sql]. The SQL uses only basic
+     * math so it works with SQLite builds that do not include [cos()].
+     */
+    private function distanceParams($lat, $lon, $radius_km)
+    {
+        $lat_delta = $radius_km / 111.195;
+        $lon_scale = cos(deg2rad($lat));
+        $lon_delta = ($lon_scale > 0.01 ? $lat_delta / $lon_scale : 360);
+        return [
+            ':min_lat' => max($lat - $lat_delta, -90),
+            ':max_lat' => min($lat + $lat_delta, 90),
+            ':min_lon' => max($lon - $lon_delta, -180),
+            ':max_lon' => min($lon + $lon_delta, 180),
+            ':lon_scale' => $lon_scale,
+        ];
+    }
+
+    /**
+     * Replace [distance_sort] (squared degrees) with [distance_km]
+     */
+    private function withDistance($records)
+    {
+        foreach ($records as &$record) {
+            $record['distance_km'] = round(sqrt($record['distance_sort']) * 111.195, 3);
+            unset($record['distance_sort']);
+        }
+        return $records;
+    }
+
+    /**
+     * Return a Response for a snapshot file [{name}.json.gz] or [null] if the
+     * file does not exist. The file is sent compressed when the client accepts
+     * gzip. The ETag is the MD5 of the file saved in [manifest.json] with [-gz]
+     * added for the compressed response so each encoding has its own ETag, and
+     * a matching [If-None-Match] returns 304 Not Modified.
+     */
+    private function snapshot(Application $app, $name)
+    {
+        if (!preg_match('/^[A-Za-z0-9_\-]+(\/[A-Za-z0-9_\-]+)*$/', $name)) {
+            return null;
+        }
+        $dir = Databases::geonamesSnapshotDir();
+        $path = $dir . '/' . $name . '.json.gz';
+        if ($dir === null || !is_file($path)) {
+            return null;
+        }
+        $etag = $this->snapshotEtag($dir, $name . '.json.gz', $path);
+        $res = new Response($app); // Pass CORS headers from App to Response Object
+        $res
+            ->contentType('json')
+            ->vary('Accept-Encoding');
+        if (strpos($_SERVER['HTTP_ACCEPT_ENCODING'] ?? '', 'gzip') !== false) {
+            return $res
+                ->etag($etag . '-gz')
+                ->header('Content-Encoding', 'gzip')
+                ->content(file_get_contents($path));
+        }
+        return $res
+            ->etag($etag)
+            ->content(gzdecode(file_get_contents($path)));
+    }
+
+    /**
+     * Return the ETag of a snapshot file from [manifest.json] so the file does
+     * not need to be hashed for every request. Each file's ETag is cached in
+     * APCu when it is installed so the manifest is only read once per snapshot
+     * version (the key includes the manifest modified time), otherwise the
+     * manifest is read once per request. If the file is missing from the
+     * manifest the MD5 of the file is used.
+     */
+    private function snapshotEtag($dir, $file, $path)
+    {
+        $manifest = $dir . '/manifest.json';
+        $key = 'geonames-snapshot:' . $manifest . ':' . (int)@filemtime($manifest);
+        $use_apcu = function_exists('apcu_fetch') && apcu_enabled();
+        if ($use_apcu) {
+            $etag = apcu_fetch($key . ':' . $file);
+            if ($etag !== false) {
+                return $etag;
+            }
+        }
+        if (!isset(self::$snapshot_etags[$key])) {
+            $etags = [];
+            $data = (is_file($manifest) ? json_decode(file_get_contents($manifest), true) : null);
+            foreach ($data['files'] ?? [] as $item) {
+                $etags[$item['file']] = $item['etag'];
+            }
+            self::$snapshot_etags = [$key => $etags];
+        }
+        $etag = self::$snapshot_etags[$key][$file] ?? md5_file($path);
+        if ($use_apcu) {
+            apcu_store($key . ':' . $file, $etag);
+        }
+        return $etag;
+    }
+
+    /**
+     * Build an FTS5 query for [geonames-search-prefix.sql]. Each word is quoted
+     * so that characters such as ["] and [-] are not treated as FTS5 syntax and
+     * matched as a prefix. For example [san fr] with country [US] becomes:
+     *     {name ascii_name alternate_names}: ("san"* "fr"*) AND country_code: "US"
+     */
+    private function searchPrefixQuery($city, $country)
+    {
+        $terms = [];
+        foreach (preg_split('/\s+/u', trim($city)) as $word) {
+            if (preg_match('/[\p{L}\p{N}]/u', $word)) {
+                $terms[] = '"' . str_replace('"', '""', $word) . '"*';
+            }
+        }
+        if (count($terms) === 0) {
+            return null;
+        }
+        $query = '{name ascii_name alternate_names}: (' . implode(' ', $terms) . ')';
+        if (trim($country) !== '') {
+            $query .= ' AND country_code: "' . str_replace('"', '""', trim($country)) . '"';
+        }
+        return $query;
+    }
 }
\ No newline at end of file
@@ -12,24 +12,46 @@ class Databases
      * @return Database
      */
     public static function geonames()
+    {
+        foreach (self::geonamesPaths() as $path) {
+            if (is_file($path)) {
+                $dsn = 'sqlite:' . $path;
+                return new Database($dsn);
+            }
+        }
+        $error = 'Missing file [geonames.sqlite] check that the file exists and if permissions are set.';
+        throw new \Exception($error);
+    }
+
+    /**
+     * Return the directory of JSON snapshots saved next to [geonames.sqlite]
+     * by [scripts/geonames.py] when [CREATE_SNAPSHOTS = True] or [null] if
+     * snapshots have not been created.
+     *
+     * @return string|null
+     */
+    public static function geonamesSnapshotDir()
+    {
+        foreach (self::geonamesPaths() as $path) {
+            if (is_file($path)) {
+                $dir = dirname($path) . '/geonames-snapshots';
+                return (is_dir($dir) ? $dir : null);
+            }
+        }
+        return null;
+    }
+
+    private static function geonamesPaths()
     {
         // The geonames database used by this app is large at over 2 GB
         // so if you are testing a local copy of this site and move the copy
         // from computer to computer it makes sense to add it to a custom
         // path for the computer rather than copy it with the site.
-        $paths = [
+        return [
             __DIR__ . '/../../app_data/geonames.sqlite',
             __DIR__ . '/../../../../geonames/geonames.sqlite',
             $_SERVER['DOCUMENT_ROOT'] . '/geonames/geonames.sqlite',
         ];
-        foreach ($paths as $path) {
-            if (is_file($path)) {
-                $dsn = 'sqlite:' . $path;
-                return new Database($dsn);
-            }
-        }
-        $error = 'Missing file [geonames.sqlite] check that the file exists and if permissions are set.';
-        throw new \Exception($error);
     }
 
     /**
@@ -0,0 +1,29 @@
+SELECT
+    g.geonames_id,
+    g.name,
+    g.feature_class,
+    g.feature_code,
+    g.country_code,
+    g.admin1_code,
+    g.latitude,
+    g.longitude,
+    g.population,
+    g.elevation,
+    g.timezone,
+    -- Squared distance in degrees of latitude from the center of the box, [:lon_scale]
+    -- is cos(center latitude). Distance in km = sqrt(distance_sort) * 111.195
+    (g.latitude - (:min_lat + :max_lat) / 2.0) * (g.latitude - (:min_lat + :max_lat) / 2.0)
+        + (g.longitude - (:min_lon + :max_lon) / 2.0) * :lon_scale * (g.longitude - (:min_lon + :max_lon) / 2.0) * :lon_scale AS distance_sort
+FROM geonames_rtree r
+INNER JOIN geonames g ON g.geonames_id = r.id
+WHERE
+    r.min_lat <= :max_lat
+    AND r.max_lat >= :min_lat
+    AND r.min_lon <= :max_lon
+    AND r.max_lon >= :min_lon
+    AND (r.feature_class = :feature_class OR :feature_class = '') -- Handle empty Params
+    AND g.latitude BETWEEN :min_lat AND :max_lat
+    AND g.longitude BETWEEN :min_lon AND :max_lon
+ORDER BY 
+    distance_sort
+LIMIT 100
\ No newline at end of file
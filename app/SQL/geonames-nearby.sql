@@ -0,0 +1,27 @@
+SELECT
+    g.geonames_id,
+    g.name,
+    g.feature_class,
+    g.feature_code,
+    g.country_code,
+    g.admin1_code,
+    g.latitude,
+    g.longitude,
+    g.population,
+    g.elevation,
+    g.timezone,
+    -- Squared distance in degrees of latitude (equirectangular approximation), [:lon_scale]
+    -- is cos(:latitude). Distance in km = sqrt(distance_sort) * 111.195
+    (g.latitude - :latitude) * (g.latitude - :latitude)
+        + (g.longitude - :longitude) * :lon_scale * (g.longitude - :longitude) * :lon_scale AS distance_sort
+FROM geonames_rtree r
+INNER JOIN geonames g ON g.geonames_id = r.id
+WHERE
+    r.min_lat <= :max_lat
+    AND r.max_lat >= :min_lat
+    AND r.min_lon <= :max_lon
+    AND r.max_lon >= :min_lon
+    AND (r.feature_class = :feature_class OR :feature_class = '') -- Handle empty Params
+ORDER BY 
+    distance_sort
+LIMIT :limit
\ No newline at end of file
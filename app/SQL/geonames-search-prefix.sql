@@ -0,0 +1,26 @@
+SELECT
+    g.geonames_id,
+    g.name,
+    g.feature_class,
+    g.feature_code,
+    g.country_code,
+    g.cc2,
+    g.admin1_code,
+    g.admin2_code,
+    g.admin3_code,
+    g.admin4_code,
+    g.population,
+    g.elevation,
+    g.dem,
+    g.timezone,
+    g.modification_date
+FROM geonames_search
+INNER JOIN geonames_search_rank r ON r.rank = geonames_search.rowid
+INNER JOIN geonames g ON g.geonames_id = r.geonames_id
+WHERE
+    geonames_search MATCH :query -- FTS5 Query, example: {name ascii_name alternate_names}: ("san"* "fr"*)
+    AND g.feature_class = 'P'
+    AND g.feature_code NOT IN ('PPLCH', 'PPLH', 'PPLQ', 'PPLW')
+ORDER BY 
+    geonames_search.rowid
+LIMIT 20
\ No newline at end of file
@@ -33,11 +33,14 @@ then you can run this file directly with Python or by using the standard Flask C
 This app is intended for as a free demo on and runs from a single server. If using similar
 code for a large site with many simultaneous users you would likely want to run many
 servers (GPU instead of CPU) behind a load balancer and consider scenarios such as
-Rate Limiting and Memory Caching results of predictions that might be repeated.
+Rate Limiting. Results of image predictions that are repeated (for example the
+sample images on the demo pages) are cached in memory, see [USE_PREDICTION_CACHE].
 
 Install (if using PyTorch):
     python3 -m pip install flask flask_cors numpy torchvision
 
+The files [logistic_model.py], [vector_index.py], and [geonames.py] must be copied to the same directory as this file.
+
 Install (if using TensorFlow):
     python3 install numpy==1.21 keras==2.11.0 flask flask-cors Pillow scikit-learn
     # Depending on Machine:
@@ -46,33 +49,269 @@ Install (if using TensorFlow):
 """
 # System Imports
 import os
+import io
+import re
+import atexit
 import sys
 import traceback
-import tempfile
 import json
 import pickle
-import secrets
+import time
+import hashlib
+import math
+import gc
+import signal
+import socket
+import bisect
+import cProfile
+import pstats
+import asyncio
+import urllib.parse
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
 
 # Flask Import
-from flask import Flask, request, send_file, Response
+from flask import Flask, Request, request, send_file, Response, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import BadRequest, NotFound, RequestEntityTooLarge, ServiceUnavailable
 
 USE_PYTORCH = True
 
+# Model Loading. When [True] models are loaded in a background thread so that
+# the server starts right away and [/healthz] responds. Until models are loaded
+# and a warmup prediction has run [/readyz] and prediction routes return 503.
+# Use [False] with [gunicorn --preload] so models are loaded before workers start.
+LOAD_MODELS_IN_BACKGROUND = True
+
+# Dynamic Micro-Batching (PyTorch only). When enabled, images posted at the
+# same time to [/predict/resnet50] are collected into a single tensor batch
+# and the model runs once per batch rather than once per image. The first
+# image of a batch waits at most [BATCH_MAX_WAIT_MS] for other images to
+# arrive so single requests are only delayed by the size of the wait window.
+# Requests must be handled by multiple threads for batches to form, for example:
+#     gunicorn -w 1 --threads 8 -b 127.0.0.1:5000 app:app
+USE_BATCHING = True
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT_MS = 10
+
+# Upload Limits. Images are read and decoded from memory so uploads larger
+# than [MAX_UPLOAD_BYTES] are rejected before being read and images with more
+# than [MAX_IMAGE_PIXELS] are rejected after reading only the image header.
+# Both return a 413 response. The byte limit matches [client_max_body_size 8M]
+# from the nginx setup docs.
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+
+# Prediction Cache. Results from [/predict/resnet50] are cached in memory using
+# a hash of the uploaded file so that repeated images skip decoding and inference.
+# The least recently used result is removed once either limit is reached.
+# Set [CACHE_TTL_SECONDS = None] to keep results until they are evicted.
+# Cache stats can be viewed from [/predict/resnet50/cache].
+USE_PREDICTION_CACHE = True
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# JPEG Draft Mode (PyTorch only). Large JPEG images such as photos from a phone
+# are decoded by the JPEG decoder at a reduced scale (1/2, 1/4, or 1/8) rather
+# than at full resolution and then resized. The decoded image is always kept
+# at least [JPEG_DRAFT_MIN_SCALE] times larger than the resize target so that
+# predictions match those from a full decode. To compare results and timing:
+#     Website\scripts\ai-ml-resnet50-preprocess-benchmark.py
+USE_JPEG_DRAFT = True
+JPEG_DRAFT_MIN_SCALE = 2
+
+# ResNet50 Backend (PyTorch only). Options for CPU inference:
+#   'eager'             - Standard PyTorch model with float32 weights
+#   'scripted'          - TorchScript model compiled with [torch.jit.script]
+#   'traced'            - TorchScript model created with [torch.jit.trace]
+#   'quantized-dynamic' - Dynamic int8 quantization of the final Linear layer
+#   'quantized-static'  - Static int8 quantized ResNet50 from torchvision (CPU only)
+#   'channels-last'     - Standard model using the channels-last memory format
+# To verify that a backend returns the same top-5 labels as 'eager'
+# and to compare latency and memory of all backends run:
+#     Website\scripts\ai-ml-resnet50-backends.py
+RESNET50_BACKEND = 'eager'
+RESNET50_BACKENDS = ['eager', 'scripted', 'traced', 'quantized-dynamic', 'quantized-static', 'channels-last']
+
+# Image Classification Models (PyTorch only). Every model in [IMAGE_MODELS] is
+# loaded at startup and clients can select one with the [model] form field or
+# query string parameter of [/predict/resnet50], example [?model=resnet18].
+# [DEFAULT_IMAGE_MODEL] is used when no model is specified. All models use the
+# same image transforms and ImageNet labels so the response has the same format.
+# Each model adds to the memory used by every server process so by default only
+# ResNet50 is loaded; add models here or see [AUTO_MODELS] to use other models.
+# ResNet50 uses [RESNET50_BACKEND], other models use the standard PyTorch model.
+# Approximate size and CPU speed compared to ResNet50:
+#   'resnet50'           - 100 MB, most accurate
+#   'resnet18'           -  45 MB, about 2x faster
+#   'mobilenet_v3_large' -  22 MB, about 4x faster
+#   'mobilenet_v3_small' -  10 MB, about 10x faster and the least accurate
+IMAGE_MODELS = ['resnet50']
+DEFAULT_IMAGE_MODEL = 'resnet50'
+
+# Automatic Model Selection. When [model=auto] is requested (or when using
+# [DEFAULT_IMAGE_MODEL = 'auto']) the first model in [AUTO_MODELS] is used unless
+# the server is busy, in which case the next (cheaper) model in the list is used.
+# A model is skipped when [AUTO_MAX_QUEUE_DEPTH] or more requests are waiting for
+# admission control or when the average latency of its recent requests is over
+# [AUTO_MAX_LATENCY_MS]. Latency older than [AUTO_LATENCY_WINDOW_SECONDS] is
+# ignored so that the more accurate model is used again once traffic drops.
+# Only models that are loaded can be selected; models in [AUTO_MODELS] are also
+# loaded at startup when [DEFAULT_IMAGE_MODEL = 'auto'], otherwise add them to
+# [IMAGE_MODELS] so that [model=auto] can switch to them.
+AUTO_MODELS = ['resnet50', 'mobilenet_v3_large']
+AUTO_MAX_QUEUE_DEPTH = 2
+AUTO_MAX_LATENCY_MS = 750
+AUTO_LATENCY_WINDOW_SECONDS = 30
+
+# Similar Image Search (PyTorch and ResNet50 only). [/predict/resnet50/embedding]
+# returns the 2048 value embedding from the ResNet50 pooling layer (the input to
+# the final classification layer) which is calculated by the same forward pass as
+# the predictions. [/predict/resnet50/similar] finds the most similar images that
+# were previously added to an in-memory [VectorIndex] from [vector_index.py].
+# The index keeps up to [IMAGE_INDEX_MAX_ITEMS] images and the oldest images are
+# removed first; 10,000 images use 40 MB with 'float16' or 80 MB with 'float32'.
+# When [IMAGE_INDEX_FILE] is set the index is loaded when the app starts and saved
+# by a background thread every [IMAGE_INDEX_SAVE_SECONDS] if images were added,
+# and once more when the app exits. When using pre-forked or multiple workers
+# each process has its own index.
+USE_IMAGE_INDEX = True
+IMAGE_INDEX_DTYPE = 'float16'
+IMAGE_INDEX_MAX_ITEMS = 10000
+IMAGE_INDEX_FILE = 'image-index.npz'
+IMAGE_INDEX_SAVE_SECONDS = 60
+
+# Request Profiling. When [PROFILING_ENABLED = True] a single request can be
+# profiled by adding the header [X-Profile: 1] or the query string [?profile=1].
+# If [PROFILING_TOKEN] is set then the header or query string value must match it.
+# A Python profile ([cProfile], view with [python3 -m pstats] or snakeviz), a
+# PyTorch operator trace (open in https://ui.perfetto.dev or chrome://tracing),
+# and a text summary of both are saved to [PROFILING_DIR] and the file name is
+# returned in the [X-Profile-Id] response header. The oldest files are removed
+# once the directory is larger than [PROFILING_MAX_BYTES]. Profiled requests
+# run the model on the request thread rather than with [USE_BATCHING] so that
+# all work is included, and only one request is profiled at a time. When [False]
+# the profiler is not added to the app so normal requests have no extra cost.
+PROFILING_ENABLED = False
+PROFILING_TOKEN = None
+PROFILING_DIR = 'profiles'
+PROFILING_MAX_BYTES = 100 * 1024 * 1024
+
+# Geonames Data. Routes under [/data/geonames/...] return the same results as the
+# PHP routes in [app/routes-data.php] from the SQLite database that is created by
+# [scripts/geonames.py] using [GeonamesDb] from [geonames.py] and the SQL files
+# from the [SQL] directory next to this file. When [GEONAMES_FILE = None] the file
+# is found using the paths from [app/Middleware/Databases.php]. Each process keeps a pool
+# of up to [GEONAMES_POOL_SIZE] read-only connections that use memory-mapped I/O
+# for the first [GEONAMES_MMAP_BYTES] of the file. Results are cached (LRU) by SQL
+# file and parameters until [GEONAMES_CACHE_ENTRIES] or [GEONAMES_CACHE_ROWS] is
+# reached and the cache is cleared when the database file changes. If the database
+# does not exist the routes return 503 and the rest of the app is not affected.
+USE_GEONAMES = True
+GEONAMES_FILE = None
+GEONAMES_POOL_SIZE = 4
+GEONAMES_MMAP_BYTES = 256 * 1024 * 1024
+GEONAMES_CACHE_ENTRIES = 5000
+GEONAMES_CACHE_ROWS = 200000
+
+# Server Mode when running this file directly [python3 app.py]:
+#   'flask'   - Flask Development Server
+#   'prefork' - Models are loaded once and then [PREFORK_WORKERS] worker processes
+#               are forked from the main process. Model weights are shared by all
+#               workers (copy-on-write) rather than each worker loading its own copy
+#               as happens with [gunicorn -w 2]. [TORCH_THREADS] is the total number
+#               of PyTorch intra-op threads and is split evenly between workers.
+#               The main process restarts workers that exit. Linux/macOS only.
+#   'async'   - Connections are handled by an asyncio event loop which reads the
+#               full request (including slow image uploads) before the request is
+#               passed to Flask on a pool of [ASYNC_EXECUTOR_WORKERS] threads. This
+#               keeps threads free for inference rather than waiting on the network.
+#               Routes, JSON responses, and CORS headers are the same as with
+#               Flask because the same Flask app handles each request. Streamed
+#               responses are sent once complete. Up to [ASYNC_MAX_CONNECTIONS]
+#               connections are handled at a time (others wait to be read) and
+#               request bodies held in memory by all connections are limited to
+#               [ASYNC_MAX_BUFFERED_BYTES]; a request that would go over the limit
+#               gets a 503 response with [Retry-After].
+SERVER_MODE = 'flask'
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 5000
+PREFORK_WORKERS = 2
+ASYNC_EXECUTOR_WORKERS = 4
+ASYNC_READ_TIMEOUT = 60
+ASYNC_MAX_CONNECTIONS = 100
+ASYNC_MAX_BUFFERED_BYTES = 64 * 1024 * 1024
+
+# Number of records scored at a time by [/predict/pima-indians-diabetes/batch].
+# Results are streamed back after each group of records is scored.
+PIMA_BATCH_SIZE = 1000
+
+# Admission Control. This server is shared with other sites so the number of
+# predictions running at the same time is limited to [MAX_IN_FLIGHT_PREDICTIONS]
+# and up to [MAX_QUEUED_PREDICTIONS] additional requests wait for up to
+# [QUEUE_TIMEOUT_SECONDS]. Once the queue is full a 503 response with a
+# [Retry-After] header is returned right away rather than letting requests pile up.
+#
+# With micro-batching a slot is held by each request (not each batch) from
+# decoding the image until its batch has run, so a batch can never have more
+# than [MAX_IN_FLIGHT_PREDICTIONS] images and [MAX_IN_FLIGHT_PREDICTIONS] must
+# be at least [BATCH_MAX_SIZE] (checked at startup). The batcher runs one batch
+# at a time per model, so the limit mostly bounds memory for decoded images.
+# Images in the running batch keep their slots, so the next batch can only fill
+# from the remaining slots; the default of 2 x [BATCH_MAX_SIZE] lets a full
+# batch form while the previous one runs (with 32 concurrent requests and a
+# limit of 8 the batches had 3 to 5 images, with 16 most batches were full).
+MAX_IN_FLIGHT_PREDICTIONS = 16
+MAX_QUEUED_PREDICTIONS = 16
+QUEUE_TIMEOUT_SECONDS = 10
+RETRY_AFTER_SECONDS = 2
+
+# CPU Budget. Explicit thread counts keep latency predictable and prevent the
+# libraries from starting one thread per core for every process.
+#   [CPU_AFFINITY]          - Set of CPU cores this process may use, example {0, 1}
+#                             or [None] for all cores (Linux only).
+#   [TORCH_THREADS]         - PyTorch intra-op threads, [None] uses one per core
+#                             from [CPU_AFFINITY]. Split between pre-forked workers.
+#   [TORCH_INTEROP_THREADS] - PyTorch inter-op threads.
+#   [NUMPY_THREADS]         - OpenMP/BLAS threads used by NumPy. This is set from
+#                             environment variables so it must be set before NumPy
+#                             is imported. Existing environment variables are kept.
+CPU_AFFINITY = None
+TORCH_THREADS = None
+TORCH_INTEROP_THREADS = 1
+NUMPY_THREADS = 1
+if CPU_AFFINITY is not None and hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, CPU_AFFINITY)
+if TORCH_THREADS is None:
+    TORCH_THREADS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+if NUMPY_THREADS is not None:
+    for name in ['OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        os.environ.setdefault(name, str(NUMPY_THREADS))
+
 # Data and Machine Learning Libraries
 import numpy as np
-from sklearn.linear_model import LogisticRegression
+from logistic_model import LogisticModel
+from vector_index import VectorIndex
+from geonames import GeonamesDb
 if USE_PYTORCH:
     import torch
     from torchvision import models, transforms
-    from PIL import Image
+    from torchvision.models import quantization as quantized_models
+    torch.set_num_threads(TORCH_THREADS)
+    if TORCH_INTEROP_THREADS is not None:
+        torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
 else:
     import tensorflow as tf
     from tensorflow.keras.applications.resnet50 import ResNet50
     from tensorflow.keras.preprocessing import image
     from tensorflow.keras.applications.resnet50 import preprocess_input, decode_predictions
+from PIL import Image, UnidentifiedImageError
 
 # ------------------------------------------------------------------
 # App Setup
@@ -80,30 +319,58 @@ else:
 # only once when the site is first started and not on each request.
 # ------------------------------------------------------------------
 
+class MemoryUploadRequest(Request):
+    """
+    Flask Request that keeps uploaded files in memory. By default Werkzeug
+    saves files larger than 500 KB to a temporary file while the form is
+    parsed. The total size is limited by [MAX_CONTENT_LENGTH].
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
 # Start Flask and setup CORS Support
 app = Flask(__name__)
+app.request_class = MemoryUploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 CORS(app)
 
 # Load the Model for Image Classification (ResNet50 using pre-built ImageNet).
 # Expect 10 - 30 seconds for the model to load. Weights are downloaded
-# and saved to the local computer on first use.
-start = datetime.now()
-print(f'Loading Model at {start}')
+# and saved to the local computer on first use. Models are loaded from
+# [load_models()] which by default runs in a background thread so that
+# the server starts right away; see [LOAD_MODELS_IN_BACKGROUND].
 device = None
 weights = None
+model_resnet50 = None
+model_pima = None
+image_models = {}
+embedding_resnet50 = None
+image_index = None
 if USE_PYTORCH:
-    if torch.cuda.is_available():
+    # Quantized models only run on the CPU
+    if torch.cuda.is_available() and not RESNET50_BACKEND.startswith('quantized'):
         device = torch.device('cuda')
     else:
         device = torch.device('cpu')
+    # Only the category labels are used from [weights.meta]
+    # so this does not require the weights to be downloaded.
     weights = models.ResNet50_Weights.DEFAULT
-    model_resnet50 = models.resnet50(weights=weights).to(device)
-    model_resnet50.eval()
-else:
-    model_resnet50 = ResNet50(weights='imagenet')
-end = datetime.now()
-seconds = (end - start).total_seconds()
-print(f'ResNet50 Model Loaded at {end} in {seconds} seconds')
+    # Models that can be used in [IMAGE_MODELS], {name: (model function, weights)}.
+    # Weights are downloaded only for the models that are loaded.
+    IMAGE_MODEL_REGISTRY = {
+        'resnet50': (models.resnet50, weights),
+        'resnet18': (models.resnet18, models.ResNet18_Weights.DEFAULT),
+        'mobilenet_v3_large': (models.mobilenet_v3_large, models.MobileNet_V3_Large_Weights.DEFAULT),
+        'mobilenet_v3_small': (models.mobilenet_v3_small, models.MobileNet_V3_Small_Weights.DEFAULT),
+    }
+    # Image transforms are created once and used for every request
+    preprocess_resnet50 = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
 
 # When using a Webserver (Gunicorn, waitress, etc) the requests will be
 # multi-threaded so the following line along with [with graph.as_default():]
@@ -114,10 +381,11 @@ if not USE_PYTORCH:
     if USE_GRAPH:
         graph = tf.get_default_graph()
 
-# Load model for the Binary Classification Demo.
+# Model for the Binary Classification Demo.
 # Model was created by [website\scripts\ai-ml-pima-indians-diabetes-build.py]
-# Loading this requires [sklearn] to be installed but it doesn't have
-# to be imported at the top of this file. If you are testing locally
+# The JSON file is scored with NumPy by [LogisticModel] from [logistic_model.py]
+# so sklearn is not needed. Loading the pickle file requires [sklearn] to be
+# installed but it doesn't have to be imported at the top of this file. If you are testing locally
 # then generate the model first or download from CDN to this directory.
 # This will also work if the [static-files] repository is downloaded
 # for full local setup. See additional info in server setup docs.
@@ -129,22 +397,397 @@ file_name = 'pima-indians-diabetes.json' if USE_JSON_FILE else 'pima-indians-dia
 model_path = os.path.join(cur_dir, file_name)
 if not os.path.exists(model_path):
     model_path = os.path.join(cur_dir, '../../static-files/ai_ml/models', file_name)
-if USE_JSON_FILE:
-    with open(model_path, 'r') as file:
-        data = json.load(file)
-    model_pima = LogisticRegression(data['params'])
-    for name, value in data.items():
-        if name.endswith('_'):
-            setattr(model_pima, name, np.array(value))
-else:
-    with open(model_path, 'rb') as file:
-        model_pima = pickle.load(file)
-print(f'sklearn Model Loaded from file: ' + model_path)
+
+# Model Snapshot (PyTorch only). When enabled a TorchScript version of the
+# ResNet50 backend is saved to [MODEL_SNAPSHOT_FILE] the first time the model is loaded and
+# then loaded from the file on the next start. Loading the snapshot skips
+# building the Python model and does not need the downloaded weights so
+# the server is ready in a few seconds. Delete the file to rebuild it.
+USE_MODEL_SNAPSHOT = False
+MODEL_SNAPSHOT_FILE = os.path.join(cur_dir, f'resnet50.{RESNET50_BACKEND}.pt')
+
+# Similar Image Search Index, see [USE_IMAGE_INDEX]
+if IMAGE_INDEX_FILE is not None:
+    IMAGE_INDEX_FILE = os.path.join(cur_dir, IMAGE_INDEX_FILE)
+image_index_lock = threading.Lock()
+image_index_save_lock = threading.Lock()
+image_index_unsaved = 0
+image_index_saver_pid = None
+
+# Geonames Database, see [USE_GEONAMES]. Connections are opened on first use
+# so that each pre-forked worker opens its own connections.
+if GEONAMES_FILE is None:
+    for path in [
+        os.path.join(cur_dir, '..', 'app_data', 'geonames.sqlite'),
+        os.path.join(cur_dir, '..', '..', '..', 'geonames', 'geonames.sqlite'),
+    ]:
+        if os.path.isfile(path):
+            GEONAMES_FILE = os.path.realpath(path)
+            break
+geonames = None
+geonames_lock = threading.Lock()
+
+# Status of Model Loading, used by [/readyz]
+models_ready = threading.Event()
+model_load_error = None
+model_load_seconds = None
+
+
+class ChannelsLast(torch.nn.Module if USE_PYTORCH else object):
+    """
+    Model wrapper that converts input to the channels-last memory format
+    (NHWC) which allows PyTorch to use faster CPU convolution kernels.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+class ResNetEmbedding(torch.nn.Module if USE_PYTORCH else object):
+    """
+    Model wrapper that runs the layers of a torchvision ResNet and returns both
+    the pooled embedding from the layer before [fc] and the classification
+    logits so that one forward pass is used for both. This works with all of
+    the [RESNET50_BACKENDS] and with snapshots because the layers of TorchScript
+    and quantized models have the same names as the standard model. Traced
+    models must be saved and loaded again before their layers can be called,
+    see [build_resnet50()] and [load_resnet50()].
+    """
+    def __init__(self, model):
+        super().__init__()
+        # [original_name] is the class name of a TorchScript model
+        self.channels_last = (getattr(model, 'original_name', type(model).__name__) == 'ChannelsLast')
+        self.model = model.model if self.channels_last else model
+        self.quantized = hasattr(self.model, 'quant')
+
+    def forward(self, x):
+        model = self.model
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.quantized:
+            # [bn1] and [relu] are fused into [conv1] for quantized models
+            x = model.maxpool(model.conv1(model.quant(x)))
+        else:
+            x = model.maxpool(model.relu(model.bn1(model.conv1(x))))
+        x = model.layer4(model.layer3(model.layer2(model.layer1(x))))
+        embedding = torch.flatten(model.avgpool(x), 1)
+        logits = model.fc(embedding)
+        if self.quantized:
+            embedding, logits = model.dequant(embedding), model.dequant(logits)
+        return embedding, logits
+
+
+def build_resnet50(backend):
+    """ Create ResNet50 for one of the options in [RESNET50_BACKENDS] """
+    if backend not in RESNET50_BACKENDS:
+        raise ValueError(f'Unknown ResNet50 backend [{backend}], options: {RESNET50_BACKENDS}')
+    if backend == 'quantized-static':
+        # Pre-quantized weights from torchvision, uses the x86 [fbgemm] engine
+        weights_int8 = quantized_models.ResNet50_QuantizedWeights.DEFAULT
+        torch.backends.quantized.engine = weights_int8.meta['backend']
+        model = quantized_models.resnet50(weights=weights_int8, quantize=True)
+        return model.eval()
+    model = models.resnet50(weights=weights).to(device)
+    model.eval()
+    if backend == 'scripted':
+        model = torch.jit.script(model)
+    elif backend == 'traced':
+        with torch.no_grad():
+            model = torch.jit.trace(model, torch.zeros(1, 3, 224, 224, device=device))
+        # Save and reload the same as a snapshot so that layers can be called
+        # directly by [ResNetEmbedding], this is not allowed for traced models.
+        buffer = io.BytesIO()
+        torch.jit.save(model, buffer)
+        buffer.seek(0)
+        model = torch.jit.load(buffer, map_location=device).eval()
+    elif backend == 'quantized-dynamic':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == 'channels-last':
+        model = ChannelsLast(model).eval()
+    return model
+
+
+def load_resnet50():
+    """ Load ResNet50 from the saved snapshot or from the downloaded weights """
+    if not USE_PYTORCH:
+        return ResNet50(weights='imagenet')
+    if USE_MODEL_SNAPSHOT and os.path.exists(MODEL_SNAPSHOT_FILE):
+        print(f'Loading ResNet50 snapshot from file: {MODEL_SNAPSHOT_FILE}')
+        if RESNET50_BACKEND == 'quantized-static':
+            torch.backends.quantized.engine = quantized_models.ResNet50_QuantizedWeights.DEFAULT.meta['backend']
+        model = torch.jit.load(MODEL_SNAPSHOT_FILE, map_location=device)
+        return model.eval()
+    model = build_resnet50(RESNET50_BACKEND)
+    if USE_MODEL_SNAPSHOT:
+        if not isinstance(model, torch.jit.ScriptModule):
+            with torch.no_grad():
+                model = torch.jit.trace(model, torch.zeros(1, 3, 224, 224, device=device))
+        torch.jit.save(model, MODEL_SNAPSHOT_FILE)
+        print(f'Saved ResNet50 snapshot to file: {MODEL_SNAPSHOT_FILE}')
+        # Use the saved file so the model is the same as on the next start,
+        # layers of a model that was just traced cannot be called directly.
+        model = torch.jit.load(MODEL_SNAPSHOT_FILE, map_location=device).eval()
+    return model
+
+
+def image_model_names():
+    """ Models to load at startup, see [IMAGE_MODELS] and [AUTO_MODELS] """
+    names = list(IMAGE_MODELS)
+    if DEFAULT_IMAGE_MODEL == 'auto':
+        names += [name for name in AUTO_MODELS if name not in names]
+    return names
+
+
+def load_image_model(name):
+    """ Load one of the models from [IMAGE_MODELS] and return an [ImageModel] """
+    if name == 'resnet50':
+        categories = (weights.meta['categories'] if USE_PYTORCH else None)
+        return ImageModel(name, load_resnet50(), categories)
+    if not USE_PYTORCH or name not in IMAGE_MODEL_REGISTRY:
+        options = list(IMAGE_MODEL_REGISTRY) if USE_PYTORCH else ['resnet50']
+        raise ValueError(f'Unknown image model [{name}], options: {options}')
+    create_model, model_weights = IMAGE_MODEL_REGISTRY[name]
+    model = create_model(weights=model_weights).to(device)
+    return ImageModel(name, model.eval(), model_weights.meta['categories'])
+
+
+def resnet50_parity(reference, model, images):
+    """
+    Compare top-5 labels from a ResNet50 backend against a reference model
+    (normally 'eager') for a batch of preprocessed images. Returns counts
+    of images with the same top-1 label and the same set of top-5 labels.
+    """
+    with torch.no_grad():
+        expected = torch.topk(reference(images), 5).indices.tolist()
+        actual = torch.topk(model(images), 5).indices.tolist()
+    return {
+        'images': len(expected),
+        'top1_match': sum(1 for a, b in zip(expected, actual) if a[0] == b[0]),
+        'top5_match': sum(1 for a, b in zip(expected, actual) if set(a) == set(b)),
+    }
+
+
+def load_image_index():
+    """ Load the similar image index from [IMAGE_INDEX_FILE] or create a new index """
+    if IMAGE_INDEX_FILE is not None and os.path.exists(IMAGE_INDEX_FILE):
+        index = VectorIndex.load(IMAGE_INDEX_FILE, IMAGE_INDEX_MAX_ITEMS)
+        print(f'Loaded {len(index)} images from index file: {IMAGE_INDEX_FILE}')
+        return index
+    # 2048 is the size of the ResNet50 pooling layer
+    return VectorIndex(2048, IMAGE_INDEX_DTYPE, IMAGE_INDEX_MAX_ITEMS)
+
+
+def save_image_index():
+    """
+    Save the similar image index if images were added since the last save.
+    Called from the background saver thread and when the app exits. Request
+    threads only hold [image_index_lock] to count added images so they never
+    wait for the file to be written.
+    """
+    global image_index_unsaved
+    if IMAGE_INDEX_FILE is None or image_index is None:
+        return
+    with image_index_save_lock:
+        with image_index_lock:
+            unsaved = image_index_unsaved
+            image_index_unsaved = 0
+        if unsaved == 0:
+            return
+        try:
+            image_index.save(IMAGE_INDEX_FILE)
+        except Exception:
+            with image_index_lock:
+                image_index_unsaved += unsaved
+            raise
+
+
+def image_index_saver():
+    while True:
+        time.sleep(IMAGE_INDEX_SAVE_SECONDS)
+        try:
+            save_image_index()
+        except Exception as e:
+            print(f'Error saving image index: {e}')
+
+
+def start_image_index_saver():
+    """
+    Start the background thread that saves the image index. Like [InferenceBatcher]
+    the thread is started on first use so pre-forked workers start their own.
+    """
+    global image_index_saver_pid
+    if IMAGE_INDEX_FILE is None or image_index_saver_pid == os.getpid():
+        return
+    with image_index_lock:
+        if image_index_saver_pid != os.getpid():
+            threading.Thread(target=image_index_saver, daemon=True).start()
+            image_index_saver_pid = os.getpid()
+
+
+def load_pima():
+    if USE_JSON_FILE:
+        model = LogisticModel.from_json(model_path)
+    else:
+        with open(model_path, 'rb') as file:
+            model = pickle.load(file)
+    print(f'Pima Model Loaded from file: ' + model_path)
+    return model
+
+
+def warmup_models():
+    """
+    Run a prediction with each model so that memory allocation and other
+    one-time setup happens before the first request rather than during it.
+
+    A single image is used: a larger warmup batch makes the allocator reserve
+    memory that is private to each pre-forked worker (with 'resnet50' on CPU
+    about 60 MB of private dirty memory per worker compared to about 145 MB
+    when warming up with [BATCH_MAX_SIZE] images). [embedding_resnet50]
+    shares the backbone of the 'resnet50' model so it is not run separately.
+    """
+    for image_model in image_models.values():
+        if USE_PYTORCH:
+            with torch.no_grad():
+                image_model.model(torch.zeros(1, 3, 224, 224, device=device))
+        else:
+            image_model.model.predict(np.zeros((1, 224, 224, 3)))
+    model_pima.predict_proba([[0] * 8])
+
+
+def load_models(warmup=True):
+    """
+    Load all models, then optionally run a warmup prediction and mark the
+    app as ready. Errors are saved so that they can be returned by [/readyz].
+    """
+    global model_resnet50, model_pima, embedding_resnet50, image_index, model_load_error, model_load_seconds
+    try:
+        start = datetime.now()
+        print(f'Loading Model at {start}')
+        # Only ResNet50 is available when using TensorFlow
+        for name in (image_model_names() if USE_PYTORCH else ['resnet50']):
+            model_start = datetime.now()
+            image_models[name] = load_image_model(name)
+            end = datetime.now()
+            seconds = (end - model_start).total_seconds()
+            print(f'Image Model [{name}] Loaded at {end} in {seconds} seconds')
+        if 'resnet50' in image_models:
+            model_resnet50 = image_models['resnet50'].model
+            if USE_PYTORCH and USE_IMAGE_INDEX:
+                categories = image_models['resnet50'].categories
+                embedding_resnet50 = ImageModel('resnet50', ResNetEmbedding(model_resnet50), categories)
+                image_index = load_image_index()
+                atexit.register(save_image_index)
+        if DEFAULT_IMAGE_MODEL != 'auto' and DEFAULT_IMAGE_MODEL not in image_models:
+            raise ValueError(f'[DEFAULT_IMAGE_MODEL = {DEFAULT_IMAGE_MODEL}] must be one of [IMAGE_MODELS] or "auto"')
+        model_pima = load_pima()
+        if warmup:
+            warmup_models()
+            models_ready.set()
+        model_load_seconds = (datetime.now() - start).total_seconds()
+    except Exception as e:
+        model_load_error = e
+        raise
+
+
+def wait_for_models():
+    """ Block until models are ready, used by scripts that import this file """
+    while not models_ready.wait(0.1):
+        if model_load_error is not None:
+            raise model_load_error
 
 # ----------------------------------------------------------------------------
 # General Helper Functions
 # ----------------------------------------------------------------------------
 
+class Metrics:
+    """
+    In-process counters and histograms that are returned from [/metrics] in
+    Prometheus text format. Timing a stage only adds a call to [perf_counter()]
+    and a short lock so it can be used on every request. When using the
+    pre-forked server or multiple Gunicorn workers each process has its own
+    metrics and the values returned depend on which process handles [/metrics].
+    """
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {
+            'aiml_requests_total': ('counter', 'Requests by endpoint and response status'),
+            'aiml_errors_total': ('counter', 'Requests by endpoint that returned a 5xx response'),
+            'aiml_stage_seconds': ('histogram', 'Time spent in each stage of handling a request'),
+            'aiml_batch_size': ('histogram', 'Number of images in each image model batch'),
+            'aiml_image_model_requests_total': ('counter', 'Image classification requests by selected model'),
+        }
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        index = bisect.bisect_left(buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+            histogram[1][index] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        """ Time a block of code, example: [with metrics.timer('decode'):] """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('aiml_stage_seconds', time.perf_counter() - start, (('stage', stage),))
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+    def render(self, gauges=None):
+        """ Return all metrics in Prometheus text exposition format """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (value[0], list(value[1]), value[2], value[3]) for key, value in self.histograms.items()}
+        lines = []
+        described = set()
+        def describe(name, metric_type, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, *self.help.get(name, ('counter', name)))
+            lines.append(f'{name}{self.format_labels(labels)} {value}')
+        for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            describe(name, *self.help.get(name, ('histogram', name)))
+            cumulative = 0
+            for bucket, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{self.format_labels(labels + (("le", bucket),))} {cumulative}')
+            lines.append(f'{name}_sum{self.format_labels(labels)} {total}')
+            lines.append(f'{name}_count{self.format_labels(labels)} {count}')
+        for name, (metric_type, help_text, value) in (gauges or {}).items():
+            describe(name, metric_type, help_text)
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
 def json_encoder(obj):
     """
     JSON encoder for objects not handled by default
@@ -161,6 +804,82 @@ def json_encoder(obj):
     raise TypeError('Type {obj.__class__} is not handled for encoding'.format(**locals()))
 
 
+def models_required(func):
+    """
+    When added to a route a 503 response is returned until
+    models have finished loading and the app is ready.
+    """
+    @wraps(func)
+    def check_models(*args, **kwargs):
+        if not models_ready.is_set():
+            if model_load_error is not None:
+                raise ServiceUnavailable('Error loading models: ' + str(model_load_error), retry_after=5)
+            raise ServiceUnavailable('Models are loading', retry_after=5)
+        return func(*args, **kwargs)
+    return check_models
+
+
+class AdmissionControl:
+    """
+    Limit the number of predictions that run at the same time. Requests wait
+    for an open slot in a bounded queue and are rejected right away with a
+    503 response once the queue is full or after waiting [timeout] seconds.
+    """
+    def __init__(self, max_in_flight, max_queued, timeout):
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def acquire(self):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                if self.waiting >= self.max_queued:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+            try:
+                acquired = self.slots.acquire(timeout=self.timeout)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            if not acquired:
+                with self.lock:
+                    self.rejected += 1
+                return False
+        with self.lock:
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    @contextmanager
+    def slot(self):
+        """ Run a block of code once a slot is available, example: [with admission.slot():] """
+        if not self.acquire():
+            raise ServiceUnavailable('Server is busy, try again later', retry_after=RETRY_AFTER_SECONDS)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': self.in_flight, 'waiting': self.waiting, 'rejected': self.rejected}
+
+
+if USE_PYTORCH and USE_BATCHING and MAX_IN_FLIGHT_PREDICTIONS < BATCH_MAX_SIZE:
+    raise ValueError(f'[MAX_IN_FLIGHT_PREDICTIONS = {MAX_IN_FLIGHT_PREDICTIONS}] must be at least [BATCH_MAX_SIZE = {BATCH_MAX_SIZE}] when batching is used')
+admission = AdmissionControl(MAX_IN_FLIGHT_PREDICTIONS, MAX_QUEUED_PREDICTIONS, QUEUE_TIMEOUT_SECONDS)
+
+
 def json_response(func):
     """
     When added to a route the response will be sent as a JSON Response.
@@ -172,56 +891,341 @@ def json_response(func):
     def create_json_response(*args, **kwargs):
         """ Call the decorated function and specify 'Content-Type' header """
         resp = func(*args, **kwargs)
-        json_text = json.dumps(resp, default=json_encoder)
+        with metrics.timer('json_encode'):
+            json_text = json.dumps(resp, default=json_encoder)
         return Response(json_text, content_type='application/json')
     return create_json_response
 
+
+class PredictionCache:
+    """
+    Thread-safe in-memory LRU Cache keyed by the SHA-256 hash of the uploaded
+    file. Size is limited by the number of entries and by an estimate of
+    memory used for each entry (length of the value as JSON). Entries older
+    than [ttl] seconds are treated as a cache miss.
+    """
+    def __init__(self, max_entries, max_bytes, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and self.ttl is not None and time.monotonic() - item[1] > self.ttl:
+                self.remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        size = len(json.dumps(value, default=json_encoder)) + len(key)
+        with self.lock:
+            if key in self.items:
+                self.remove(key)
+            self.items[key] = (value, time.monotonic(), size)
+            self.size += size
+            while self.items and (len(self.items) > self.max_entries or self.size > self.max_bytes):
+                self.remove(next(iter(self.items)))
+                self.evictions += 1
+
+    def remove(self, key):
+        _, _, size = self.items.pop(key)
+        self.size -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.items),
+                'bytes': self.size,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+if USE_PREDICTION_CACHE:
+    prediction_cache = PredictionCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL_SECONDS)
+
+def geonames_db():
+    """ Return the [GeonamesDb], opened the first time it is used """
+    global geonames
+    if geonames is None:
+        with geonames_lock:
+            if geonames is None:
+                if not USE_GEONAMES:
+                    raise ServiceUnavailable('Geonames routes are disabled')
+                if GEONAMES_FILE is None or not os.path.isfile(GEONAMES_FILE):
+                    raise ServiceUnavailable('Missing file [geonames.sqlite] check that the file exists and if permissions are set.')
+                geonames = GeonamesDb(
+                    GEONAMES_FILE,
+                    os.path.join(cur_dir, 'SQL'),
+                    pool_size=GEONAMES_POOL_SIZE,
+                    mmap_bytes=GEONAMES_MMAP_BYTES,
+                    cache_entries=GEONAMES_CACHE_ENTRIES,
+                    cache_rows=GEONAMES_CACHE_ROWS)
+    return geonames
+
 # ----------------------------------------------------------------------------
 # Machine Learning Functions
 # ----------------------------------------------------------------------------
 
-def resnet50_prediction(model, file_path):
+class InferenceBatcher:
+    """
+    Collects image tensors submitted from multiple request threads into a
+    single batch and runs the model once for the entire batch. Each caller
+    blocks on a Future and receives only the output row for its own image.
+
+    The worker thread is started on first use and restarted if the process
+    has been forked because threads are not copied to child processes.
+    """
+    def __init__(self, model, max_batch_size, max_wait_ms):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+
+    def predict(self, tensor):
+        """ Submit a single preprocessed image and wait for the model output """
+        self.start()
+        future = Future()
+        self.queue.put((tensor, future))
+        return future.result()
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                thread = threading.Thread(target=self.run, args=(self.queue,), daemon=True)
+                thread.start()
+                self.pid = os.getpid()
+
+    def run(self, items):
+        while True:
+            # Block until the first item arrives, then gather more items
+            # until either the batch is full or the wait window has passed.
+            batch = [items.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(items.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Run the model once and return each row to the calling thread
+            metrics.observe('aiml_batch_size', len(batch), buckets=Metrics.BATCH_SIZE_BUCKETS)
+            try:
+                tensors = torch.stack([tensor for tensor, _ in batch]).to(device)
+                with torch.no_grad(), metrics.timer('forward'):
+                    output = self.model(tensors)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for n, (_, future) in enumerate(batch):
+                if isinstance(output, tuple):
+                    future.set_result(tuple(value[n] for value in output))
+                else:
+                    future.set_result(output[n])
+
+
+class ImageModel:
+    """
+    An image classification model from [IMAGE_MODELS] along with its labels.
+    Each model has its own [InferenceBatcher] and keeps a moving average of
+    recent request latency which is used for automatic model selection.
+    """
+    def __init__(self, name, model, categories=None):
+        self.name = name
+        self.model = model
+        self.categories = categories
+        self.batcher = None
+        if USE_PYTORCH and USE_BATCHING:
+            self.batcher = InferenceBatcher(model, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+        self.lock = threading.Lock()
+        self.latency = None
+        self.latency_time = 0
+
+    def record_latency(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            if self.latency is None or now - self.latency_time > AUTO_LATENCY_WINDOW_SECONDS:
+                self.latency = seconds
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * seconds
+            self.latency_time = now
+
+    def recent_latency(self):
+        """ Average latency in seconds, or [None] if there are no recent requests """
+        with self.lock:
+            if self.latency is None or time.monotonic() - self.latency_time > AUTO_LATENCY_WINDOW_SECONDS:
+                return None
+            return self.latency
+
+
+def select_image_model(name):
+    """
+    Return the [ImageModel] for the model name from a request. For 'auto'
+    the first model in [AUTO_MODELS] that is not busy is returned and the
+    last model is used when all others are busy.
+    """
+    if name != 'auto':
+        if name not in image_models:
+            raise BadRequest(f'Unknown model [{name}], options: {["auto"] + list(image_models)}')
+        return image_models[name]
+    candidates = [image_models[name] for name in AUTO_MODELS if name in image_models]
+    if not candidates:
+        return image_models[next(iter(image_models))]
+    queue_depth = admission.stats()['waiting']
+    for image_model in candidates[:-1]:
+        latency = image_model.recent_latency()
+        if queue_depth < AUTO_MAX_QUEUE_DEPTH and (latency is None or latency * 1000 < AUTO_MAX_LATENCY_MS):
+            return image_model
+    return candidates[-1]
+
+
+
+def read_image_upload():
+    """
+    Read image from Form Post into memory. The form is parsed to memory by
+    [MemoryUploadRequest] so the file is never written to disk. The image type
+    is determined from file contents by Pillow rather than file extension so
+    the file name is not used. Previously the image was saved to a temp file
+    and then opened from the file.
+    """
+    with metrics.timer('upload'):
+        file = request.files['file']
+        data = file.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise RequestEntityTooLarge()
+    return data
+
+
+def load_image(data):
+    """
+    Open an uploaded image from memory. Pillow only reads the image header
+    when opening so the size is checked before the full image is decoded.
+    Files that are not a supported image return a 400 response.
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        raise BadRequest('Uploaded file is not a supported image type')
+    except OSError as e:
+        raise BadRequest(f'Uploaded file is not a valid image: {e}')
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise RequestEntityTooLarge(f'Image size {width}x{height} is larger than the limit of {MAX_IMAGE_PIXELS} pixels')
+    return img
+
+
+def jpeg_draft(img, resize):
+    """
+    Configure Pillow to decode a large JPEG image at a reduced scale. [resize]
+    is the size of the shortest side used by the model transforms. This must
+    be called before the image data is loaded.
+    """
+    if not USE_JPEG_DRAFT or img.format != 'JPEG':
+        return img
+    width, height = img.size
+    scale = min(width, height) / (resize * JPEG_DRAFT_MIN_SCALE)
+    if scale >= 2:
+        img.draft('RGB', (math.ceil(width / scale), math.ceil(height / scale)))
+    return img
+
+
+def convert_rgb(img):
+    """ Decode the full image, corrupt or truncated image data returns a 400 response """
+    try:
+        return img.convert('RGB')
+    except (UnidentifiedImageError, OSError) as e:
+        raise BadRequest(f'Uploaded image could not be decoded: {e}')
+
+
+def image_tensor(img):
+    """ Decode and transform an image to the tensor format used by PyTorch image models """
+    with metrics.timer('decode'):
+        img = convert_rgb(jpeg_draft(img, 256))
+    with metrics.timer('preprocess'):
+        return preprocess_resnet50(img)
+
+
+def image_model_output(image_model, tensor):
+    """ Run a single image through a model, using the batcher when enabled """
+    if USE_BATCHING and not (PROFILING_ENABLED and getattr(profiling_state, 'active', False)):
+        # Includes time waiting for the batch to form and run
+        with metrics.timer('inference'):
+            return image_model.batcher.predict(tensor)
+    metrics.observe('aiml_batch_size', 1, buckets=Metrics.BATCH_SIZE_BUCKETS)
+    with torch.no_grad(), metrics.timer('forward'):
+        output = image_model.model(tensor.unsqueeze(0).to(device))
+    return tuple(value[0] for value in output) if isinstance(output, tuple) else output[0]
+
+
+def top_predictions(categories, logits):
+    """ Return the first result and all labels with a probability 10% or higher """
+    with metrics.timer('topk'):
+        probabilities, indices = torch.topk(logits, 5)
+        probabilities = probabilities.softmax(0).tolist()
+        indices = indices.tolist()
+    results = []
+    for index, probability in enumerate(probabilities):
+        if index == 0 or probability >= 0.1:
+            results.append({
+                'label': categories[indices[index]],
+                'probability': probability,
+            })
+    return results
+
+
+def image_prediction(image_model, img):
     """
     Image Classification using PyTorch (or Keras and TensorFlow). The first
     result and all labels with a probability 10% or higher are returned.
     """
+    model = image_model.model
     if USE_PYTORCH:
         # https://pytorch.org/vision/main/models.html
         # https://pytorch.org/TensorRT/_notebooks/Resnet50-example.html
         # https://pytorch.org/blog/how-to-train-state-of-the-art-models-using-torchvision-latest-primitives/
-        img = Image.open(file_path).convert('RGB')
-        preprocess = transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
-        img = preprocess(img)
-        img = img.unsqueeze(0).to(device)
-        with torch.no_grad():
-            predictions = model_resnet50(img)
-        probabilities, indices = torch.topk(predictions, 5)
-        probabilities = probabilities.squeeze().softmax(0).tolist()
-        indices = indices.squeeze().tolist()
-        results = []
-        for index, probability in enumerate(probabilities):
-            if index == 0 or probability >= 0.1:
-                class_id = indices[index]
-                results.append({
-                    'label': weights.meta['categories'][class_id],
-                    'probability': probability,
-                })
-        return results
+        predictions = image_model_output(image_model, image_tensor(img))
+        return top_predictions(image_model.categories, predictions)
     else:
-        img = image.load_img(file_path, target_size=(224, 224))
+        # Same as [image.load_img(path, target_size=(224, 224))]
+        img = convert_rgb(img).resize((224, 224), Image.NEAREST)
         x = image.img_to_array(img)
         x = np.expand_dims(x, axis=0)
         x = preprocess_input(x)
-        if USE_GRAPH:
-            with graph.as_default():
+        with metrics.timer('forward'):
+            if USE_GRAPH:
+                with graph.as_default():
+                    preds = model.predict(x)
+            else:
                 preds = model.predict(x)
-        else:
-            preds = model.predict(x)
         predictions = decode_predictions(preds, top=5)[0]
         results = []
         for index, (wordnet, label, probability) in enumerate(predictions):
@@ -233,6 +1237,101 @@ def resnet50_prediction(model, file_path):
                 })
         return results
 
+
+def image_embedding(img):
+    """
+    Return the ResNet50 embedding as a NumPy array
+    and the predictions from the same forward pass.
+    """
+    embedding, logits = image_model_output(embedding_resnet50, image_tensor(img))
+    return embedding.float().cpu().numpy(), top_predictions(embedding_resnet50.categories, logits)
+
+
+PIMA_FIELDS = ['pregnancies', 'glucose', 'bloodPressure', 'skinThickness', 'insulin', 'bmi', 'diabetesPedigreeFunction', 'age']
+
+def pima_record(data):
+    """
+    Read record values from a JSON object, format looks like this:
+        {"values":[1,89,66,23,94,28.1,0.167,21]}
+    Or if submitted by the Entry Form demo they will come in as an object:
+        {"pregnancies":"1","glucose":"89",...
+    """
+    if 'values' in data:
+        return data['values']
+    record = []
+    for field in PIMA_FIELDS:
+        value = data[field]
+        value = float(value) if '.' in value else int(value)
+        record.append(value)
+    return record
+
+
+def pima_prediction(records):
+    """
+    Score a list of records in a single pass and return arrays of predictions
+    and probabilities. For a binary LogisticRegression [predict()] returns the
+    second class when the probability is greater than 0.5 so only
+    [predict_proba()] needs to be called.
+    """
+    probabilities = model_pima.predict_proba(records)[:,1]
+    predictions = model_pima.classes_[(probabilities > 0.5).astype(int)]
+    return predictions, probabilities
+
+
+def pima_batch_results(rows):
+    """
+    Generator that scores JSON records from [rows] in groups of [PIMA_BATCH_SIZE]
+    and yields one result line for each row in the same order as the input.
+    Rows that are not valid return an error for the row only.
+    """
+    def score(group):
+        valid = [(index, record) for index, record, error in group if error is None]
+        scores = {}
+        if valid:
+            with metrics.timer('pima_score'):
+                predictions, probabilities = pima_prediction([record for _, record in valid])
+            for (index, _), prediction, probability in zip(valid, predictions, probabilities):
+                scores[index] = {'index': index, 'prediction': prediction, 'probability': probability}
+        for index, _, error in group:
+            result = scores[index] if error is None else {'index': index, 'error': error}
+            yield json.dumps(result, default=json_encoder) + '\n'
+
+    group = []
+    for index, row in enumerate(rows):
+        try:
+            if isinstance(row, (str, bytes)):
+                # Blank NDJSON lines have no result but are counted so
+                # that [index] is the line number of the input.
+                if not row.strip():
+                    continue
+                row = json.loads(row)
+            record = pima_record(row)
+            if len(record) != len(PIMA_FIELDS):
+                raise ValueError(f'Expected {len(PIMA_FIELDS)} values but received {len(record)}')
+            np.asarray(record, dtype=float)
+            group.append((index, record, None))
+        except Exception as e:
+            error = f'Missing field: {e}' if isinstance(e, KeyError) else f'{type(e).__name__}: {e}'
+            group.append((index, None, error))
+        if len(group) >= PIMA_BATCH_SIZE:
+            yield from score(group)
+            group = []
+    if group:
+        yield from score(group)
+
+# ----------------------------------------------------------------------------
+# Load Models
+# ----------------------------------------------------------------------------
+
+# With the pre-forked server models are loaded before the worker
+# processes are created and each worker runs its own warmup.
+if __name__ == '__main__' and SERVER_MODE == 'prefork':
+    load_models(warmup=False)
+elif LOAD_MODELS_IN_BACKGROUND:
+    threading.Thread(target=load_models, daemon=True).start()
+else:
+    load_models()
+
 # ----------------------------------------------------------------------------
 # Routes
 # ----------------------------------------------------------------------------
@@ -247,56 +1346,272 @@ def home():
     return send_file('index.htm')
 
 
+@app.route("/healthz")
+@json_response
+def healthz():
+    return {'status': 'ok'}
+
+
+@app.route("/readyz")
+def readyz():
+    if not models_ready.is_set():
+        status = 'error' if model_load_error is not None else 'loading'
+        res = json.dumps({'ready': False, 'status': status, 'error': str(model_load_error or '')})
+        return res, 503, {'Content-Type': 'application/json', 'Retry-After': '5'}
+    res = json.dumps({'ready': True, 'status': 'ready', 'load_seconds': model_load_seconds})
+    return res, 200, {'Content-Type': 'application/json'}
+
+
 @app.route("/predict/resnet50", methods = ['POST'])
+@models_required
 @json_response
 def predict_resnet50():
-    # Read image from Form Post and Save to Temp Dir.
-    # This is using a random hex string for the file name. The image
-    # type is determined from file contents by Keras/Pillow rather than
-    # file extension so it is not needed. If the code were using the actual
-    # name the code similar to the commented version could be used however
-    # additional safety checks would be needed for duplicate file names, etc.
-    #
-    # from werkzeug import secure_filename
-    # file_path = os.path.join(tempfile.gettempdir(), secure_filename(file.name))
-    #
-    file = request.files['file']
-    file_path = os.path.join(tempfile.gettempdir(), secrets.token_hex(10))
-    file.save(file_path)
+    data = read_image_upload()
+
+    # Select the model, see [IMAGE_MODELS] and [AUTO_MODELS]
+    image_model = select_image_model(request.values.get('model', DEFAULT_IMAGE_MODEL))
+    metrics.inc('aiml_image_model_requests_total', (('model', image_model.name),))
+
+    # Return the cached result if the same image was previously submitted
+    if USE_PREDICTION_CACHE:
+        with metrics.timer('cache_lookup'):
+            cache_key = PredictionCache.key(data) + ':' + image_model.name
+            predictions = prediction_cache.get(cache_key)
+        if predictions is not None:
+            return {'predictions': predictions, 'model': image_model.name}
 
-    # Predict, delete temp file, and return result
-    result = {'predictions': resnet50_prediction(model_resnet50, file_path)}
-    os.remove(file_path)
-    return result
+    # Predict and return result
+    with admission.slot():
+        start = time.perf_counter()
+        with metrics.timer('open_image'):
+            img = load_image(data)
+        predictions = image_prediction(image_model, img)
+        image_model.record_latency(time.perf_counter() - start)
+    if USE_PREDICTION_CACHE:
+        prediction_cache.set(cache_key, predictions)
+    return {'predictions': predictions, 'model': image_model.name}
+
+
+@app.route("/predict/resnet50/models")
+@models_required
+@json_response
+def image_model_list():
+    return {
+        'models': list(image_models),
+        'default': DEFAULT_IMAGE_MODEL,
+        'auto': [name for name in AUTO_MODELS if name in image_models],
+    }
+
+
+@app.route("/predict/resnet50/embedding", methods = ['POST'])
+@models_required
+@json_response
+def predict_resnet50_embedding():
+    # Return the ResNet50 embedding (2048 values) for an uploaded image along
+    # with the same predictions that [/predict/resnet50] returns.
+    if embedding_resnet50 is None:
+        raise NotFound('Image embeddings are not enabled, see [USE_IMAGE_INDEX]')
+    data = read_image_upload()
+    with admission.slot():
+        with metrics.timer('open_image'):
+            img = load_image(data)
+        embedding, predictions = image_embedding(img)
+    return {'predictions': predictions, 'model': 'resnet50', 'embedding': embedding.tolist()}
+
+
+@app.route("/predict/resnet50/similar", methods = ['POST'])
+@models_required
+@json_response
+def predict_resnet50_similar():
+    # Find the images most similar to an uploaded image from the images that
+    # were previously added to the index. Optional form fields or query string:
+    #     [k]     - Number of results, default 5 (max 50)
+    #     [add=1] - Add the image to the index after searching
+    #     [key]   - Key for the added image, defaults to a SHA-256 hash of the file
+    #     [label] - Saved with the image, defaults to the top predicted label
+    # Each result is returned as {"key", "score" (cosine similarity), "metadata"}.
+    if image_index is None:
+        raise NotFound('Similar image search is not enabled, see [USE_IMAGE_INDEX]')
+    global image_index_unsaved
+    data = read_image_upload()
+    try:
+        k = min(max(int(request.values.get('k', 5)), 1), 50)
+    except ValueError:
+        raise BadRequest('[k] must be a whole number from 1 to 50')
+    add = request.values.get('add') in ('1', 'true')
+    with admission.slot():
+        with metrics.timer('open_image'):
+            img = load_image(data)
+        embedding, predictions = image_embedding(img)
+    with metrics.timer('similar_search'):
+        results = image_index.query(embedding, k)
+    key = None
+    if add:
+        key = request.values.get('key') or PredictionCache.key(data)
+        image_index.add(key, embedding, {'label': request.values.get('label') or predictions[0]['label']})
+        with image_index_lock:
+            image_index_unsaved += 1
+        start_image_index_saver()
+    return {'predictions': predictions, 'model': 'resnet50', 'results': results, 'added': key}
+
+
+@app.route("/predict/resnet50/similar/index")
+@json_response
+def image_index_stats():
+    if image_index is None:
+        return {'enabled': False}
+    return {'enabled': True, **image_index.stats()}
+
+
+@app.route("/predict/resnet50/cache")
+@json_response
+def prediction_cache_stats():
+    if not USE_PREDICTION_CACHE:
+        return {'enabled': False}
+    return {'enabled': True, **prediction_cache.stats()}
 
 
 @app.route("/predict/pima-indians-diabetes", methods = ['POST'])
+@models_required
 @json_response
 def predict_pima():
-    # Read record values from JSON post, format looks like this:
-    #     {"values":[1,89,66,23,94,28.1,0.167,21]}
-    # Or if submitted by the Entry Form demo they will come in as an object:
-    #     {"pregnancies":"1","glucose":"89",...
+    # Read record values from JSON post, see [pima_record()] for format.
     #
     # This service is a simple demo and assumes all values are filled in.
     # The actual data has some 0/null values. For a production system
     # they could be handled using a known median value for the column
     # or other methods.
-    json = request.get_json()
-    if 'values' in json:
-        record = json['values']
-    else:
-        fields = ['pregnancies', 'glucose', 'bloodPressure', 'skinThickness', 'insulin', 'bmi', 'diabetesPedigreeFunction', 'age']
-        record = []
-        for field in fields:
-            value = json[field]
-            value = float(value) if '.' in value else int(value)
-            record.append(value)
+    with metrics.timer('pima_parse'):
+        record = pima_record(request.get_json())
 
     # Predict
-    prediction = model_pima.predict([record])[0]
-    probability = model_pima.predict_proba([record])[:,1][0]
-    return {'prediction': prediction, 'probability': probability}
+    with admission.slot(), metrics.timer('pima_score'):
+        predictions, probabilities = pima_prediction([record])
+    return {'prediction': predictions[0], 'probability': probabilities[0]}
+
+
+@app.route("/predict/pima-indians-diabetes/batch", methods = ['POST'])
+@models_required
+def predict_pima_batch():
+    # Score many records with one request. Records are posted either as a
+    # JSON array using the same format as [/predict/pima-indians-diabetes]:
+    #     [{"values":[1,89,66,23,94,28.1,0.167,21]}, {"pregnancies":"1",...}]
+    # Or as NDJSON [Content-Type: application/x-ndjson] with one record per line
+    # which is read as a stream. Results are streamed back as NDJSON in the same
+    # order as the input with either [prediction, probability] or [error] for each row.
+    # [index] is the position in the JSON array or the line number (starting at 0)
+    # of the NDJSON input; blank lines are counted but do not have a result:
+    #     {"index": 0, "prediction": 0.0, "probability": 0.0427}
+    if 'ndjson' in request.mimetype:
+        rows = request.stream
+    else:
+        rows = request.get_json()
+        if not isinstance(rows, list):
+            return 'Expected a JSON array of records', 400, {'Content-Type': 'text/plain'}
+    # The admission slot is held until all results have been streamed. It's released
+    # when the server closes the response which also happens if the client disconnects
+    # before the first result is sent, in which case the generator never runs.
+    if not admission.acquire():
+        raise ServiceUnavailable('Server is busy, try again later', retry_after=RETRY_AFTER_SECONDS)
+    response = Response(stream_with_context(pima_batch_results(rows)), content_type='application/x-ndjson')
+    response.call_on_close(admission.release)
+    return response
+
+
+@app.route("/data/geonames/countries")
+@json_response
+def geonames_countries():
+    return geonames_db().countries(request.args.get('order_by'))
+
+
+@app.route("/data/geonames/regions/<country>")
+@json_response
+def geonames_regions(country):
+    return geonames_db().regions(country)
+
+
+@app.route("/data/geonames/cities/<country>/<region>")
+@json_response
+def geonames_cities(country, region):
+    return geonames_db().cities(country, region)
+
+
+@app.route("/data/geonames/place/<geonames_id>")
+@json_response
+def geonames_place(geonames_id):
+    return geonames_db().place(geonames_id)
+
+
+@app.route("/data/geonames/search")
+@json_response
+def geonames_search():
+    return geonames_db().search(request.args.get('city'), request.args.get('country'))
+
+
+@app.route("/data/geonames/search-prefix")
+@json_response
+def geonames_search_prefix():
+    return geonames_db().search_prefix(request.args.get('city'), request.args.get('country'))
+
+
+@app.route("/data/geonames/nearby")
+@json_response
+def geonames_nearby():
+    return geonames_db().nearby(
+        request.args.get('lat'),
+        request.args.get('lon'),
+        request.args.get('feature_class', ''),
+        request.args.get('limit', 20, type=int))
+
+
+@app.route("/data/geonames/bounding-box")
+@json_response
+def geonames_bounding_box():
+    args = request.args
+    return geonames_db().bounding_box(args.get('min_lat'), args.get('max_lat'), args.get('min_lon'), args.get('max_lon'), args.get('feature_class', ''))
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # Prometheus text format, counters from the prediction cache and
+    # model load time are read when this route is called.
+    gauges = {
+        'aiml_models_ready': ('gauge', 'Models are loaded and ready (1) or loading (0)', int(models_ready.is_set())),
+        'aiml_model_load_seconds': ('gauge', 'Time to load all models in seconds', model_load_seconds or 0),
+    }
+    stats = admission.stats()
+    gauges.update({
+        'aiml_predictions_in_flight': ('gauge', 'Predictions currently running', stats['in_flight']),
+        'aiml_predictions_waiting': ('gauge', 'Requests waiting for an admission slot', stats['waiting']),
+        'aiml_predictions_rejected_total': ('counter', 'Requests rejected with 503 by admission control', stats['rejected']),
+    })
+    if USE_PREDICTION_CACHE:
+        stats = prediction_cache.stats()
+        gauges.update({
+            'aiml_prediction_cache_hits_total': ('counter', 'Prediction cache hits', stats['hits']),
+            'aiml_prediction_cache_misses_total': ('counter', 'Prediction cache misses', stats['misses']),
+            'aiml_prediction_cache_evictions_total': ('counter', 'Prediction cache evictions', stats['evictions']),
+            'aiml_prediction_cache_entries': ('gauge', 'Items in the prediction cache', stats['entries']),
+            'aiml_prediction_cache_bytes': ('gauge', 'Estimated size of the prediction cache', stats['bytes']),
+        })
+    if geonames is not None:
+        stats = geonames.stats()['cache']
+        gauges.update({
+            'aiml_geonames_cache_hits_total': ('counter', 'Geonames query cache hits', stats['hits']),
+            'aiml_geonames_cache_misses_total': ('counter', 'Geonames query cache misses', stats['misses']),
+            'aiml_geonames_cache_entries': ('gauge', 'Items in the Geonames query cache', stats['entries']),
+            'aiml_geonames_cache_invalidations_total': ('counter', 'Times the Geonames query cache was cleared because the database changed', stats['invalidations']),
+        })
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.after_request
+def count_request(response):
+    endpoint = request.endpoint or 'not_found'
+    metrics.inc('aiml_requests_total', (('endpoint', endpoint), ('status', response.status_code)))
+    if response.status_code >= 500:
+        metrics.inc('aiml_errors_total', (('endpoint', endpoint),))
+    return response
 
 # ----------------------------------------------------------------------
 # Error Handling
@@ -306,12 +1621,30 @@ def predict_pima():
 # so if any errors occur then the info is helpful to solve errors.
 # ----------------------------------------------------------------------
 
+@app.errorhandler(400)
+def bad_request(e):
+    res = 'Bad Request: ' + str(e.description)
+    return res, 400, {'Content-Type': 'text/plain'}
+
 @app.errorhandler(404)
 def page_not_found(e):
     res = 'Page not found: ' + str(e)
     res = res + '\n' + str(request)
     return res, 404, {'Content-Type': 'text/plain'}
 
+@app.errorhandler(413)
+def request_too_large(e):
+    res = 'Request too large: ' + str(e)
+    return res, 413, {'Content-Type': 'text/plain'}
+
+@app.errorhandler(503)
+def service_unavailable(e):
+    res = 'Service Unavailable: ' + str(e.description)
+    headers = {'Content-Type': 'text/plain'}
+    if getattr(e, 'retry_after', None) is not None:
+        headers['Retry-After'] = str(e.retry_after)
+    return res, 503, headers
+
 @app.errorhandler(500)
 def error_handler(e):
     res = 'Server Error: ' + str(type(e)) + ' ' + str(e)
@@ -322,11 +1655,393 @@ def error_handler(e):
     res = res + '\n' + str(request)
     return res, 500, {'Content-Type': 'text/plain'}
 
+# ----------------------------------------------------------------------------
+# Request Profiling
+# ----------------------------------------------------------------------------
+
+# Set while a profiled request is running on the current thread
+profiling_state = threading.local()
+
+
+class RequestProfiler:
+    """
+    WSGI middleware that profiles requests that include the [X-Profile] header
+    or [profile] query string, see [PROFILING_ENABLED]. The full response is
+    read while profiling so that streamed responses are included.
+    """
+    def __init__(self, wsgi_app, directory, max_bytes, token=None):
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.token = token
+        self.lock = threading.Lock()
+
+    def requested(self, environ):
+        value = environ.get('HTTP_X_PROFILE')
+        if value is None:
+            value = urllib.parse.parse_qs(environ.get('QUERY_STRING', '')).get('profile', [None])[0]
+        if value is None:
+            return False
+        if self.token is not None:
+            return value == self.token
+        return value.lower() not in ('', '0', 'false')
+
+    def __call__(self, environ, start_response):
+        # Requests that arrive while another request is being profiled are not profiled
+        if not self.requested(environ) or not self.lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+        try:
+            path = environ.get('PATH_INFO', '/')
+            name = '{0}-{1}-{2}'.format(
+                datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                re.sub(r'[^A-Za-z0-9]+', '-', path).strip('-')[:60] or 'home',
+                os.getpid())
+            def start_profiled_response(status, headers, exc_info=None):
+                return start_response(status, list(headers) + [('X-Profile-Id', name)], exc_info)
+
+            python_profile = cProfile.Profile()
+            torch_profile = None
+            if USE_PYTORCH:
+                torch_profile = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True)
+                torch_profile.start()
+            profiling_state.active = True
+            start = time.perf_counter()
+            python_profile.enable()
+            try:
+                result = self.wsgi_app(environ, start_profiled_response)
+                try:
+                    body = b''.join(result)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            finally:
+                python_profile.disable()
+                seconds = time.perf_counter() - start
+                profiling_state.active = False
+                if torch_profile is not None:
+                    torch_profile.stop()
+            try:
+                self.save(name, environ, seconds, python_profile, torch_profile)
+            except Exception:
+                # The response is still returned if the profile cannot be saved
+                traceback.print_exc()
+            return [body]
+        finally:
+            self.lock.release()
+
+    def save(self, name, environ, seconds, python_profile, torch_profile):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        python_profile.dump_stats(path + '.prof')
+        summary = io.StringIO()
+        summary.write('{0} {1}?{2}\n'.format(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), environ.get('QUERY_STRING', '')))
+        summary.write(f'Time: {seconds * 1000:.2f} ms\n\n')
+        pstats.Stats(python_profile, stream=summary).sort_stats('cumulative').print_stats(40)
+        if torch_profile is not None:
+            torch_profile.export_chrome_trace(path + '.trace.json')
+            summary.write(torch_profile.key_averages().table(sort_by='self_cpu_time_total', row_limit=30))
+        with open(path + '.txt', 'w') as file:
+            file.write(summary.getvalue())
+        self.rotate()
+
+    def rotate(self):
+        """ Remove the oldest files once the directory is larger than [max_bytes] """
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                pass
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+if PROFILING_ENABLED:
+    app.wsgi_app = RequestProfiler(app.wsgi_app, os.path.join(cur_dir, PROFILING_DIR), PROFILING_MAX_BYTES, PROFILING_TOKEN)
+
+# ----------------------------------------------------------------------------
+# Pre-forked Server
+# ----------------------------------------------------------------------------
+
+def run_prefork():
+    """
+    Start [PREFORK_WORKERS] server processes that share a single listening
+    socket and the models loaded by the main process. No inference should
+    run in the main process before the workers are forked.
+    """
+    from werkzeug.serving import make_server
+
+    sock = socket.create_server((SERVER_HOST, SERVER_PORT), backlog=128)
+    threads_per_worker = max(1, TORCH_THREADS // PREFORK_WORKERS)
+
+    # Move all objects created while loading models to a permanent generation
+    # so that garbage collection in the workers does not write to the shared
+    # memory pages (which would cause each page to be copied).
+    gc.freeze()
+
+    workers = set()
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if USE_PYTORCH:
+                torch.set_num_threads(threads_per_worker)
+            warmup_models()
+            models_ready.set()
+            threaded = USE_PYTORCH and USE_BATCHING
+            server = make_server(SERVER_HOST, SERVER_PORT, app, threaded=threaded, fd=sock.fileno())
+            server.serve_forever()
+            os._exit(0)
+        workers.add(pid)
+
+    def stop(signum, frame):
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    print(f'Starting {PREFORK_WORKERS} workers with {threads_per_worker} threads each on http://{SERVER_HOST}:{SERVER_PORT}')
+    for _ in range(PREFORK_WORKERS):
+        start_worker()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        pid, status = os.wait()
+        if pid in workers:
+            workers.remove(pid)
+            print(f'Worker {pid} exited with status {status}, starting a new worker')
+            start_worker()
+
+# ----------------------------------------------------------------------------
+# Async Server
+# ----------------------------------------------------------------------------
+
+def call_wsgi_app(environ):
+    """ Run the Flask app for a single request and return the full response """
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+    result = app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response[0], response[1], body
+
+
+class BufferedBytes:
+    """
+    Total size of request bodies held in memory by the async server. Only used
+    from the event loop thread so no lock is needed.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+
+    def reserve(self, size):
+        if self.size + size > self.limit:
+            return False
+        self.size += size
+        return True
+
+    def release(self, size):
+        self.size -= size
+
+
+async def send_error(writer, status, message, headers=()):
+    """ Send a plain text error from the async server and close the connection """
+    body = message.encode()
+    lines = [f'HTTP/1.1 {status}', 'Content-Type: text/plain; charset=utf-8', *headers,
+             f'Content-Length: {len(body)}', 'Connection: close']
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+
+async def handle_connection(reader, writer, executor, buffered):
+    """
+    Read HTTP/1.1 requests from a connection on the event loop and run each
+    complete request on the executor. Keep-alive connections are supported.
+    Malformed requests get a 400 response and the connection is closed.
+    """
+    loop = asyncio.get_running_loop()
+    remote_addr = (writer.get_extra_info('peername') or ('', 0))[0]
+    reserved = 0
+    try:
+        while True:
+            # Request line and headers
+            request_line = await asyncio.wait_for(reader.readline(), ASYNC_READ_TIMEOUT)
+            if not request_line.strip():
+                break
+            try:
+                method, target, version = request_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+                if not method or not target or not version.startswith('HTTP/'):
+                    raise ValueError(request_line)
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), ASYNC_READ_TIMEOUT)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, sep, value = line.decode('latin-1').partition(':')
+                    if not sep or not name.strip():
+                        raise ValueError(line)
+                    name = name.strip().upper().replace('-', '_')
+                    headers[name] = (headers[name] + ',' + value.strip()) if name in headers else value.strip()
+                content_length = int(headers.get('CONTENT_LENGTH', 0) or 0)
+                if content_length < 0:
+                    raise ValueError(content_length)
+            except ValueError:
+                await send_error(writer, '400 BAD REQUEST', 'Malformed HTTP request')
+                break
+
+            # Request body. If the body is larger than the Flask limit then
+            # it's not read (chunked bodies stop being read once the limit
+            # is reached), Flask returns the 413 response, and the connection
+            # is closed because the rest of the body is still unread. Memory
+            # for the body is reserved from [buffered] before it is read.
+            body = b''
+            keep_alive = (version == 'HTTP/1.1' and headers.get('CONNECTION', '').lower() != 'close')
+            max_length = app.config['MAX_CONTENT_LENGTH']
+            if 'chunked' in headers.get('TRANSFER_ENCODING', '').lower():
+                chunks = []
+                length = 0
+                while True:
+                    try:
+                        size = int((await asyncio.wait_for(reader.readline(), ASYNC_READ_TIMEOUT)).split(b';')[0], 16)
+                    except ValueError:
+                        await send_error(writer, '400 BAD REQUEST', 'Malformed chunked request body')
+                        return
+                    if size == 0:
+                        # Read and discard trailer fields up to the final empty line
+                        while (await asyncio.wait_for(reader.readline(), ASYNC_READ_TIMEOUT)) not in (b'\r\n', b'\n', b''):
+                            pass
+                        break
+                    length += size
+                    if max_length is not None and length > max_length:
+                        break
+                    if not buffered.reserve(size):
+                        await send_error(writer, '503 SERVICE UNAVAILABLE', 'Server is busy, try again later', ['Retry-After: 1'])
+                        return
+                    reserved += size
+                    chunk = await asyncio.wait_for(reader.readexactly(size + 2), ASYNC_READ_TIMEOUT)
+                    chunks.append(chunk[:-2])
+                del headers['TRANSFER_ENCODING']
+                if max_length is not None and length > max_length:
+                    headers['CONTENT_LENGTH'] = str(length)
+                    keep_alive = False
+                else:
+                    body = b''.join(chunks)
+                    headers['CONTENT_LENGTH'] = str(len(body))
+            elif max_length is not None and content_length > max_length:
+                keep_alive = False
+            elif content_length:
+                if not buffered.reserve(content_length):
+                    await send_error(writer, '503 SERVICE UNAVAILABLE', 'Server is busy, try again later', ['Retry-After: 1'])
+                    break
+                reserved += content_length
+                if headers.get('EXPECT', '').lower() == '100-continue':
+                    writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                    await writer.drain()
+                body = await asyncio.wait_for(reader.readexactly(content_length), ASYNC_READ_TIMEOUT)
+
+            # Build the WSGI environ and call Flask on the executor
+            path, _, query = target.partition('?')
+            environ = {
+                'REQUEST_METHOD': method,
+                'SCRIPT_NAME': '',
+                'PATH_INFO': urllib.parse.unquote_to_bytes(path).decode('latin-1'),
+                'QUERY_STRING': query,
+                'SERVER_NAME': SERVER_HOST,
+                'SERVER_PORT': str(SERVER_PORT),
+                'SERVER_PROTOCOL': version,
+                'REMOTE_ADDR': remote_addr,
+                'CONTENT_TYPE': headers.pop('CONTENT_TYPE', ''),
+                'CONTENT_LENGTH': headers.pop('CONTENT_LENGTH', ''),
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(body),
+                'wsgi.errors': sys.stderr,
+                'wsgi.multithread': True,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            for name, value in headers.items():
+                environ['HTTP_' + name] = value
+            status, response_headers, response_body = await loop.run_in_executor(executor, call_wsgi_app, environ)
+            buffered.release(reserved)
+            reserved = 0
+
+            # Send Response. For HEAD requests the body is empty and the
+            # [Content-Length] from the app (size of the GET response) is kept.
+            lines = [f'HTTP/1.1 {status}']
+            app_content_length = None
+            for name, value in response_headers:
+                if name.lower() == 'content-length':
+                    app_content_length = value
+                elif name.lower() not in ('transfer-encoding', 'connection'):
+                    lines.append(f'{name}: {value}')
+            if method == 'HEAD':
+                response_body = b''
+                if app_content_length is not None:
+                    lines.append(f'Content-Length: {app_content_length}')
+            else:
+                lines.append(f'Content-Length: {len(response_body)}')
+            lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + response_body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        buffered.release(reserved)
+        writer.close()
+
+
+def run_async():
+    """ Start the asyncio server, see comments for [SERVER_MODE] """
+    executor = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS)
+
+    async def serve():
+        connections = asyncio.Semaphore(ASYNC_MAX_CONNECTIONS)
+        buffered = BufferedBytes(ASYNC_MAX_BUFFERED_BYTES)
+
+        async def on_connection(reader, writer):
+            async with connections:
+                await handle_connection(reader, writer, executor, buffered)
+
+        server = await asyncio.start_server(on_connection, SERVER_HOST, SERVER_PORT)
+        print(f'Starting async server with {ASYNC_EXECUTOR_WORKERS} executor threads on http://{SERVER_HOST}:{SERVER_PORT}')
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(wait=False)
+
 # ----------------------------------------------------------------------------
 # Start of Script
 # ----------------------------------------------------------------------------
 
 if __name__ == '__main__':
-    # (threaded=False) is required when running Flask
-    # directly and not using a webserver.
-    app.run(threaded=False)
+    # (threaded=False) is required when running Flask directly
+    # and not using a webserver when using TensorFlow. With PyTorch
+    # multiple threads are needed for micro-batching to form batches.
+    if SERVER_MODE == 'prefork':
+        run_prefork()
+    elif SERVER_MODE == 'async':
+        run_async()
+    else:
+        app.run(host=SERVER_HOST, port=SERVER_PORT, threaded=(USE_PYTORCH and USE_BATCHING))
@@ -0,0 +1,382 @@
+"""
+Read-only query service (standard library only) for the Geonames SQLite
+database created by [scripts/geonames.py]. Used by [app.py] for the routes
+under [/data/geonames/...] which return the same results as the PHP routes
+in [app/routes-data.php] and [app/Controllers/Geonames.php].
+
+SQL is loaded once from the [geonames-*.sql] files in [app/SQL] so the same
+queries are used by PHP and Python. Connections are opened read-only
+([mode=ro]) with [PRAGMA mmap_size] so pages are read from the OS page
+cache without being copied, and are kept in a pool so each thread uses its
+own connection. The [sqlite3] module keeps a prepared statement for each SQL
+text on each connection ([cached_statements]) so queries are only compiled
+once per connection.
+
+Results are kept in an LRU cache keyed by statement and parameters. The
+database file (and its [-wal] file) is checked at most once every
+[check_seconds] and the cache is cleared when either file changes, for
+example after [python3 geonames.py update]. If the file is replaced by a new
+import the pooled connections are also closed and reopened.
+
+Usage:
+    db = GeonamesDb('geonames.sqlite', 'SQL')
+    db.countries()                 # {'countries': [...]}
+    db.cities('US', 'CA')          # {'cities': [...]}
+    db.nearby(37.77, -122.42)      # {'places': [...]}
+    db.stats()
+"""
+import os
+import re
+import math
+import time
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Kilometers for one degree of latitude, used by the distance
+# calculation in [geonames-nearby.sql] and [geonames-bounding-box.sql]
+KM_PER_DEGREE = 111.195
+
+# Columns of the [geonames] table in the original layout from [scripts/geonames.py],
+# [place()] returns columns in this order for both the original and compact layout
+PLACE_COLUMNS = ('geonames_id', 'name', 'ascii_name', 'alternate_names', 'latitude', 'longitude',
+                 'feature_class', 'feature_code', 'country_code', 'cc2', 'admin1_code', 'admin2_code',
+                 'admin3_code', 'admin4_code', 'population', 'elevation', 'dem', 'timezone', 'modification_date')
+
+# Geonames feature classes (http://www.geonames.org/export/codes.html), an
+# empty [feature_class] matches all places
+FEATURE_CLASSES = ('A', 'H', 'L', 'P', 'R', 'S', 'T', 'U', 'V')
+
+# The [nearby()] search box starts at [NEARBY_START_KM] and grows 4 times
+# larger until enough places are found or the box reaches [NEARBY_MAX_KM].
+# Places within [NEARBY_MAX_KM] are returned even if fewer than [limit].
+NEARBY_START_KM = 25
+NEARBY_MAX_KM = 400
+
+
+def error_result(message):
+    """ Same format as [WebServiceResult::error()] in PHP """
+    return {
+        'success': False,
+        'isLoaded': False,
+        'hasError': True,
+        'errorMessage': message,
+    }
+
+
+def search_prefix_query(city, country):
+    """
+    Build an FTS5 query for [geonames-search-prefix.sql], the same as
+    [Geonames::searchPrefixQuery()] in PHP. Returns [None] if [city] does
+    not contain a letter or number.
+    """
+    terms = ['"{0}"*'.format(word.replace('"', '""')) for word in (city or '').split() if re.search(r'[^\W_]', word)]
+    if not terms:
+        return None
+    query = '{name ascii_name alternate_names}: (' + ' '.join(terms) + ')'
+    country = (country or '').strip()
+    if country:
+        query += ' AND country_code: "{0}"'.format(country.replace('"', '""'))
+    return query
+
+
+def distance_params(lat, lon, radius_km):
+    """ Box around a point and the longitude scale, same as [Geonames::distanceParams()] in PHP """
+    lat_delta = radius_km / KM_PER_DEGREE
+    lon_scale = math.cos(math.radians(lat))
+    lon_delta = (lat_delta / lon_scale if lon_scale > 0.01 else 360)
+    return {
+        'min_lat': max(lat - lat_delta, -90),
+        'max_lat': min(lat + lat_delta, 90),
+        'min_lon': max(lon - lon_delta, -180),
+        'max_lon': min(lon + lon_delta, 180),
+        'lon_scale': lon_scale,
+    }
+
+
+def with_distance(records):
+    """ Copy records replacing [distance_sort] (squared degrees) with [distance_km] """
+    results = []
+    for record in records:
+        record = dict(record)
+        record['distance_km'] = round(math.sqrt(record.pop('distance_sort')) * KM_PER_DEGREE, 3)
+        results.append(record)
+    return results
+
+
+def feature_class_error(feature_class):
+    """ Return an error result if [feature_class] is not empty or a Geonames feature class """
+    if feature_class and feature_class not in FEATURE_CLASSES:
+        return error_result('[feature_class] must be one of: ' + ', '.join(FEATURE_CLASSES))
+    return None
+
+
+def to_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of query results limited by the number of entries
+    and the total number of rows. [clear()] increments [version] so results
+    from queries that started before the cache was cleared are not saved.
+    """
+    def __init__(self, max_entries, max_rows):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.items = OrderedDict()
+        self.rows = 0
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def set(self, key, value, version):
+        with self.lock:
+            if version != self.version or key in self.items:
+                return
+            self.items[key] = value
+            self.rows += len(value)
+            while self.items and (len(self.items) > self.max_entries or self.rows > self.max_rows):
+                _, removed = self.items.popitem(last=False)
+                self.rows -= len(removed)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.rows = 0
+            self.version += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.items),
+                'rows': self.rows,
+                'max_entries': self.max_entries,
+                'max_rows': self.max_rows,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.version,
+            }
+
+
+class GeonamesDb:
+    """
+    Pool of read-only connections to [path] with cached query results.
+    Records are returned as dicts in the same format as the PHP routes.
+    Results can be shared between requests through the cache so they must
+    not be modified; functions that change records copy them first.
+    """
+    def __init__(self, path, sql_dir, pool_size=4, mmap_bytes=256 * 1024 * 1024,
+                 cache_entries=5000, cache_rows=200000, check_seconds=1.0, timeout=10):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f'Missing file [{path}] check that the file exists and if permissions are set.')
+        self.path = os.path.abspath(path)
+        self.pool_size = pool_size
+        self.mmap_bytes = mmap_bytes
+        self.check_seconds = check_seconds
+        self.timeout = timeout
+        self.statements = self.load_statements(sql_dir)
+        self.cache = ResultCache(cache_entries, cache_rows)
+        self.lock = threading.Lock()
+        self.pool = queue.LifoQueue()
+        self.created = 0
+        self.generation = 0
+        self.checked = time.monotonic()
+        self.signature = self.file_signature()
+
+    @staticmethod
+    def load_statements(sql_dir):
+        """ Return {name: sql} for [geonames-*.sql] files, example [geonames-search.sql] is 'search' """
+        statements = {}
+        for file_name in sorted(os.listdir(sql_dir)):
+            if file_name.startswith('geonames-') and file_name.endswith('.sql'):
+                with open(os.path.join(sql_dir, file_name), 'r', encoding='utf-8') as f:
+                    statements[file_name[len('geonames-'):-len('.sql')]] = f.read()
+        # Queries that are defined in the PHP Controller rather than SQL files
+        if 'countries' in statements:
+            statements['countries-by-country'] = statements['countries'].replace('population DESC,', '')
+        statements['place'] = 'SELECT * FROM geonames WHERE geonames_id = ?'
+        statements['place-alternate-names'] = 'SELECT alternate_names FROM geonames_alternate_names WHERE geonames_id = ?'
+        return statements
+
+    def connect(self):
+        db = sqlite3.connect(
+            'file:{0}?mode=ro'.format(self.path),
+            uri=True,
+            check_same_thread=False,
+            cached_statements=len(self.statements) * 2)
+        db.execute('PRAGMA mmap_size = {0:d}'.format(self.mmap_bytes))
+        return db
+
+    @contextmanager
+    def connection(self):
+        """ Use a connection from the pool, a new connection is opened if fewer than [pool_size] exist """
+        with self.lock:
+            generation = self.generation
+            create = (self.pool.empty() and self.created < self.pool_size)
+            if create:
+                self.created += 1
+        if create:
+            try:
+                db = self.connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        else:
+            try:
+                generation, db = self.pool.get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError('No Geonames database connection available') from None
+        try:
+            yield db
+        finally:
+            with self.lock:
+                if generation == self.generation:
+                    self.pool.put((generation, db))
+                    db = None
+                else:
+                    self.created -= 1
+            if db is not None:
+                db.close()
+
+    def file_signature(self):
+        """ (inode, size, modified time) of the database and [-wal] files """
+        signature = []
+        for path in (self.path, self.path + '-wal'):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def check_file(self):
+        """ Clear the cache if the database changed and reopen connections if it was replaced """
+        now = time.monotonic()
+        if now - self.checked < self.check_seconds:
+            return
+        with self.lock:
+            if now - self.checked < self.check_seconds:
+                return
+            self.checked = now
+            signature = self.file_signature()
+            if signature == self.signature:
+                return
+            replaced = (signature[0] is None or self.signature[0] is None or signature[0][0] != self.signature[0][0])
+            self.signature = signature
+            self.cache.clear()
+            if replaced:
+                self.generation += 1
+                while not self.pool.empty():
+                    _, db = self.pool.get()
+                    db.close()
+                    self.created -= 1
+
+    def query(self, name, params=()):
+        """ Run a statement by name and return a list of dicts, cached by statement and parameters """
+        self.check_file()
+        key = (name, tuple(sorted(params.items())) if isinstance(params, dict) else tuple(params))
+        records = self.cache.get(key)
+        if records is not None:
+            return records
+        version = self.cache.version
+        with self.connection() as db:
+            cursor = db.execute(self.statements[name], params)
+            columns = [column[0] for column in cursor.description]
+            records = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        self.cache.set(key, records, version)
+        return records
+
+    def stats(self):
+        with self.lock:
+            connections = {'pool_size': self.pool_size, 'open': self.created, 'idle': self.pool.qsize()}
+        return {'connections': connections, 'cache': self.cache.stats()}
+
+    # Routes from [app/routes-data.php], results use the same format as PHP
+
+    def countries(self, order_by=None):
+        return {'countries': self.query('countries-by-country' if order_by == 'country' else 'countries')}
+
+    def regions(self, country):
+        return {'regions': self.query('admin1-by-country', (country,))}
+
+    def cities(self, country, region):
+        return {'cities': self.query('20-largest-cities-in-admin1', (country, region))}
+
+    def place(self, geonames_id):
+        records = self.query('place', (geonames_id,))
+        if not records:
+            return {'place': None}
+        record = dict(records[0])
+        if 'alternate_names' not in record:
+            # Compact schema from [scripts/geonames.py] saves names in a separate table
+            names = self.query('place-alternate-names', (geonames_id,))
+            record['alternate_names'] = (names[0]['alternate_names'] if names else '')
+            record = {column: record[column] for column in PLACE_COLUMNS}
+        if record['alternate_names']:
+            record['alternate_names'] = record['alternate_names'].split(',')
+        return {'place': record}
+
+    def search(self, city, country=None):
+        if city is None or city.strip() == '':
+            return error_result('[City] is a required search option.')
+        params = {'country_code': (country or '').strip(), 'name': city.strip()}
+        return {'cities': self.query('search', params)}
+
+    def search_prefix(self, city, country=None):
+        query = search_prefix_query(city, country)
+        if query is None:
+            return error_result('[City] is a required search option.')
+        return {'cities': self.query('search-prefix', {'query': query})}
+
+    def nearby(self, lat, lon, feature_class='', limit=20):
+        """ See [Geonames::nearby()] in PHP, the search box grows until [limit] places are found """
+        lat = to_float(lat)
+        lon = to_float(lon)
+        if lat is None or lon is None or abs(lat) > 90 or abs(lon) > 180:
+            return error_result('[Lat] and [Lon] are required search options.')
+        feature_class = (feature_class or '').strip()
+        error = feature_class_error(feature_class)
+        if error is not None:
+            return error
+        limit = min(max(limit, 1), 100)
+        radius = NEARBY_START_KM
+        while True:
+            params = distance_params(lat, lon, radius)
+            params.update({'latitude': lat, 'longitude': lon, 'feature_class': feature_class, 'limit': limit})
+            records = [record for record in with_distance(self.query('nearby', params)) if record['distance_km'] <= radius]
+            if len(records) == limit or radius >= NEARBY_MAX_KM:
+                return {'places': records}
+            radius = min(radius * 4, NEARBY_MAX_KM)
+
+    def bounding_box(self, min_lat, max_lat, min_lon, max_lon, feature_class=''):
+        params = {'min_lat': to_float(min_lat), 'max_lat': to_float(max_lat), 'min_lon': to_float(min_lon), 'max_lon': to_float(max_lon)}
+        if None in params.values():
+            return error_result('[min_lat], [max_lat], [min_lon], and [max_lon] are required search options.')
+        params['feature_class'] = (feature_class or '').strip()
+        error = feature_class_error(params['feature_class'])
+        if error is not None:
+            return error
+        params['lon_scale'] = math.cos(math.radians((params['min_lat'] + params['max_lat']) / 2))
+        return {'places': with_distance(self.query('bounding-box', params))}
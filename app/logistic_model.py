@@ -0,0 +1,58 @@
+"""
+Dependency-free scorer (NumPy only) for a binary sklearn [LogisticRegression]
+model saved in JSON format by [scripts/ai-ml-pima-indians-diabetes-build.py].
+
+Scoring a logistic model is a dot product and a sigmoid so the web service
+does not need to import sklearn which saves startup time and memory for each
+worker. Results match sklearn [predict()] and [predict_proba()] to float
+tolerance, this is verified by [scripts/ai-ml-pima-indians-diabetes-load.py].
+
+Usage:
+    model = LogisticModel.from_json('pima-indians-diabetes.json')
+    model.predict([[1,89,66,23,94,28.1,0.167,21]])
+    model.predict_proba([[1,89,66,23,94,28.1,0.167,21]])[:,1]
+"""
+import json
+import numpy as np
+
+
+class LogisticModel:
+    """
+    Binary Logistic Regression using [coef_, intercept_, classes_] from a fitted
+    sklearn model. All other saved attributes ending with "_" (for example
+    "n_iter_") are also set so the object can be inspected like the sklearn model.
+    """
+    def __init__(self, coef, intercept, classes, params=None):
+        self.coef_ = np.asarray(coef, dtype=float)
+        self.intercept_ = np.asarray(intercept, dtype=float)
+        self.classes_ = np.asarray(classes)
+        self.params = params or {}
+        if len(self.classes_) != 2:
+            raise ValueError(f'Only binary models are supported, model has {len(self.classes_)} classes')
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path, 'r') as file:
+            data = json.load(file)
+        model = cls(data['coef_'], data['intercept_'], data['classes_'], data.get('params'))
+        for name, value in data.items():
+            if name.endswith('_') and not hasattr(model, name):
+                setattr(model, name, np.array(value))
+        return model
+
+    def get_params(self):
+        return dict(self.params)
+
+    def decision_function(self, X):
+        """ Return the score (log-odds) of the second class for each record """
+        X = np.asarray(X, dtype=float)
+        return X @ self.coef_[0] + self.intercept_[0]
+
+    def predict_proba(self, X):
+        """ Return an array of [probability of class 0, probability of class 1] for each record """
+        # Sigmoid written as exp(-log(1 + exp(-x))) to avoid overflow warnings for large scores
+        positive = np.exp(-np.logaddexp(0, -self.decision_function(X)))
+        return np.column_stack([1 - positive, positive])
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
@@ -53,6 +53,9 @@ $app->get('/data/geonames/regions/:country', 'Geonames.getRegions');
 $app->get('/data/geonames/cities/:country/:region', 'Geonames.getCities');
 $app->get('/data/geonames/place/:id', 'Geonames.getPlace');
 $app->get('/data/geonames/search', 'Geonames.search');
+$app->get('/data/geonames/search-prefix', 'Geonames.searchPrefix');
+$app->get('/data/geonames/nearby', 'Geonames.nearby');
+$app->get('/data/geonames/bounding-box', 'Geonames.boundingBox');
 
 $app->get('/data/example/log-table/:count', 'LogTable');
 
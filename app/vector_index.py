@@ -0,0 +1,143 @@
+"""
+In-memory vector index (NumPy only) used by [app.py] for similar image search
+with ResNet50 embeddings.
+
+Vectors are L2-normalized when added and stored in a single contiguous array
+([float16] by default which uses half the memory of [float32]) so cosine
+similarity for a query is one matrix-vector product over the whole index.
+Scores are calculated in [float32] a block of rows at a time so a [float16]
+index does not need a full [float32] copy during a query. This is a brute-force
+(exact) search which is fast enough for tens of thousands of vectors and does
+not require an outside vector database.
+
+Usage:
+    index = VectorIndex(dimensions=2048, dtype='float16')
+    index.add('image-1', embedding, {'label': 'tabby cat'})
+    index.query(embedding, k=5)  # [{'key': 'image-1', 'score': 1.0, 'metadata': {...}}]
+    index.save('image-index.npz')
+    index = VectorIndex.load('image-index.npz')
+"""
+import os
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class VectorIndex:
+    """
+    Cosine similarity index of fixed size vectors with a string key and optional
+    JSON metadata for each vector. Adding a key that already exists replaces the
+    vector. Once [max_items] is reached the oldest vector is removed.
+    """
+    QUERY_BLOCK_ROWS = 8192
+
+    def __init__(self, dimensions, dtype='float16', max_items=None):
+        self.dimensions = dimensions
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float16, np.float32):
+            raise ValueError(f'Unsupported dtype [{dtype}], use float16 or float32')
+        self.max_items = max_items
+        self.lock = threading.RLock()
+        self.vectors = np.zeros((16, dimensions), dtype=self.dtype)
+        self.keys = []
+        self.metadata = []
+        self.rows = OrderedDict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def normalize(self, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dimensions:
+            raise ValueError(f'Expected a vector with {self.dimensions} dimensions, received {vector.shape[0]}')
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def add(self, key, vector, metadata=None):
+        vector = self.normalize(vector)
+        with self.lock:
+            row = self.rows.get(key)
+            if row is None:
+                if self.max_items is not None and len(self.keys) >= self.max_items:
+                    self.remove(next(iter(self.rows)))
+                row = len(self.keys)
+                if row == len(self.vectors):
+                    self.vectors = np.resize(self.vectors, (row * 2, self.dimensions))
+                self.keys.append(key)
+                self.metadata.append(None)
+            else:
+                self.rows.move_to_end(key)
+            self.vectors[row] = vector
+            self.metadata[row] = metadata
+            self.rows[key] = row
+
+    def remove(self, key):
+        """ Remove a vector by moving the last vector into its row """
+        with self.lock:
+            row = self.rows.pop(key, None)
+            if row is None:
+                return False
+            last = len(self.keys) - 1
+            if row != last:
+                self.vectors[row] = self.vectors[last]
+                self.keys[row] = self.keys[last]
+                self.metadata[row] = self.metadata[last]
+                self.rows[self.keys[row]] = row
+            self.keys.pop()
+            self.metadata.pop()
+            return True
+
+    def query(self, vector, k=10):
+        """ Return up to [k] items with the highest cosine similarity, best match first """
+        vector = self.normalize(vector)
+        with self.lock:
+            count = len(self.keys)
+            if count == 0 or k <= 0:
+                return []
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, self.QUERY_BLOCK_ROWS):
+                end = min(start + self.QUERY_BLOCK_ROWS, count)
+                scores[start:end] = self.vectors[start:end].astype(np.float32, copy=False) @ vector
+            k = min(k, count)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [{'key': self.keys[n], 'score': float(scores[n]), 'metadata': self.metadata[n]} for n in top]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'items': len(self.keys),
+                'dimensions': self.dimensions,
+                'dtype': self.dtype.name,
+                'bytes': len(self.keys) * self.dimensions * self.dtype.itemsize,
+                'max_items': self.max_items,
+            }
+
+    def save(self, path):
+        """ Save to a [.npz] file. A temp file is written and then renamed so a partial file is never read. """
+        with self.lock:
+            count = len(self.keys)
+            vectors = self.vectors[:count].copy()
+            keys = np.array([key for key in self.rows], dtype=str)
+            order = np.array([self.rows[key] for key in self.rows], dtype=np.int64)
+            metadata = json.dumps([self.metadata[row] for row in order])
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            np.savez(file, vectors=vectors[order] if count else vectors, keys=keys, metadata=np.array(metadata))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, max_items=None):
+        with np.load(path, allow_pickle=False) as data:
+            vectors = data['vectors']
+            keys = data['keys'].tolist()
+            metadata = json.loads(str(data['metadata']))
+        index = cls(vectors.shape[1], vectors.dtype, max_items)
+        index.vectors = np.array(vectors, dtype=index.dtype) if len(vectors) else index.vectors
+        index.keys = keys
+        index.metadata = metadata
+        index.rows = OrderedDict((key, row) for row, key in enumerate(keys))
+        while max_items is not None and len(index) > max_items:
+            index.remove(next(iter(index.rows)))
+        return index
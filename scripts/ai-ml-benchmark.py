@@ -0,0 +1,260 @@
+"""
+Load-test benchmark for the AI/ML Web Service [app/app.py].
+
+This script sends requests to a local instance of the service at several
+concurrency levels and reports throughput, p50/p95/p99 latency, and the
+memory of the server and each worker process. Everything runs offline, images are generated by
+the script in several sizes and formats and Pima requests use both the
+[values] array and the field-object format from the Entry Form demo.
+
+Results are printed and saved in JSON format to [RESULTS_DIR] so that results
+can be compared after making changes to [app.py]. The server is started by this
+script when [START_SERVER = True] otherwise it must already be running at
+[BASE_URL] and [SERVER_PID] can be set to report memory usage.
+
+Memory is reported per process: [peak_rss_mb] is the peak RSS [VmHWM] and
+[pss_mb] is the proportional set size from [/proc/<pid>/smaps_rollup], where
+memory shared between processes (for example model weights shared by
+pre-forked workers) is divided between them. Only Pss can be added together.
+
+Image requests larger than [MAX_UPLOAD_BYTES] are not sent because the server
+rejects them with 413; they are listed as rejected by the upload limit.
+
+Dependencies (in addition to the dependencies of the service):
+    python3 -m pip install Pillow numpy
+
+Running:
+    python3 ai-ml-benchmark.py
+"""
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import statistics
+import subprocess
+import urllib.request
+import urllib.error
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+# Script Parameters
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.realpath(os.path.join(CUR_DIR, '..', 'app', 'app.py'))
+RESULTS_DIR = os.path.join(CUR_DIR, 'benchmark-results')
+BASE_URL = 'http://127.0.0.1:5000'
+START_SERVER = True
+SERVER_PID = None
+SERVER_START_TIMEOUT = 300
+CONCURRENCY_LEVELS = [1, 4, 8]
+REQUESTS_PER_TEST = 40
+IMAGE_SIZES = [(320, 240), (1280, 960), (4032, 3024)]
+IMAGE_FORMATS = ['JPEG', 'PNG', 'WEBP']
+
+# Same as [MAX_UPLOAD_BYTES] in [app.py]
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+
+# Random bytes are added to the end of each image so that every request
+# is unique and the result is not returned from the prediction cache.
+BYPASS_PREDICTION_CACHE = True
+
+# Sample records from [pima-indians-diabetes.csv]
+PIMA_RECORDS = [
+    [1, 89, 66, 23, 94, 28.1, 0.167, 21],
+    [5, 166, 72, 19, 175, 25.8, 0.587, 51],
+    [10, 115, 0, 0, 0, 35.3, 0.134, 29],
+    [7, 195, 70, 33, 145, 25.1, 0.163, 55],
+]
+PIMA_FIELDS = ['pregnancies', 'glucose', 'bloodPressure', 'skinThickness', 'insulin', 'bmi', 'diabetesPedigreeFunction', 'age']
+
+
+def create_image(width, height, image_format):
+    """ Create a noisy gradient image so that compressed file sizes are realistic """
+    rng = np.random.default_rng(width * height)
+    x = np.linspace(0, 255, width)
+    y = np.linspace(0, 255, height)[:, None]
+    pixels = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)), (x + y) / 2 % 256], axis=2)
+    pixels = np.clip(pixels + rng.normal(0, 20, pixels.shape), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def image_request(data):
+    """ Build a multipart form request for [/predict/resnet50] """
+    if BYPASS_PREDICTION_CACHE:
+        data = data + os.urandom(16)
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        f'--{boundary}\r\n'.encode(),
+        b'Content-Disposition: form-data; name="file"; filename="image"\r\n',
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        data,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+    return urllib.request.Request(BASE_URL + '/predict/resnet50', data=body, headers=headers, method='POST')
+
+
+def pima_request(record, use_fields):
+    """ Build a JSON request for [/predict/pima-indians-diabetes] """
+    if use_fields:
+        payload = {field: str(value) for field, value in zip(PIMA_FIELDS, record)}
+    else:
+        payload = {'values': record}
+    body = json.dumps(payload).encode()
+    headers = {'Content-Type': 'application/json'}
+    return urllib.request.Request(BASE_URL + '/predict/pima-indians-diabetes', data=body, headers=headers, method='POST')
+
+
+def send(request):
+    """ Send a request and return (seconds, success) """
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            response.read()
+            success = (response.status == 200)
+    except (urllib.error.URLError, OSError):
+        success = False
+    return time.perf_counter() - start, success
+
+
+def run_test(name, create_request, concurrency):
+    """ Send [REQUESTS_PER_TEST] requests using [concurrency] threads and return stats """
+    requests = [create_request(n) for n in range(REQUESTS_PER_TEST)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, requests))
+    seconds = time.perf_counter() - start
+    latencies = [latency * 1000 for latency, success in results if success]
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    result = {
+        'test': name,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': sum(1 for _, success in results if not success),
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(len(latencies) / seconds, 2),
+        'p50_ms': round(percentiles[49], 2) if latencies else None,
+        'p95_ms': round(percentiles[94], 2) if latencies else None,
+        'p99_ms': round(percentiles[98], 2) if latencies else None,
+    }
+    print(f'{name:<32} {concurrency:>5} {result["throughput_rps"]:>10} {str(result["p50_ms"]):>10} {str(result["p95_ms"]):>10} {str(result["p99_ms"]):>10} {result["errors"]:>7}')
+    return result
+
+
+def process_ids(pid):
+    """ Return the server process id and the ids of all child processes (Linux) """
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            for child in f.read().split():
+                pids.extend(process_ids(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def read_kb(path, field):
+    """ Return the value of a [field: value kB] line from a [/proc] file, or None """
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def process_memory(pid):
+    """ Peak RSS [VmHWM] and Pss for the server and each worker process (Linux) """
+    processes = []
+    for process_id in process_ids(pid):
+        peak_rss = read_kb(f'/proc/{process_id}/status', 'VmHWM')
+        pss = read_kb(f'/proc/{process_id}/smaps_rollup', 'Pss')
+        processes.append({
+            'pid': process_id,
+            'peak_rss_mb': None if peak_rss is None else round(peak_rss / 1024, 1),
+            'pss_mb': None if pss is None else round(pss / 1024, 1),
+        })
+    return processes
+
+
+def wait_for_server():
+    """ Wait for [/readyz] to return 200 """
+    start = time.time()
+    while time.time() - start < SERVER_START_TIMEOUT:
+        try:
+            with urllib.request.urlopen(BASE_URL + '/readyz', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f'Server at {BASE_URL} was not ready after {SERVER_START_TIMEOUT} seconds')
+
+
+def main():
+    server = None
+    pid = SERVER_PID
+    if START_SERVER:
+        server = subprocess.Popen([sys.executable, APP_FILE], cwd=os.path.dirname(APP_FILE))
+        pid = server.pid
+    try:
+        wait_for_server()
+        print('-' * 80)
+        print(f'{"Test":<32} {"Conc":>5} {"Req/sec":>10} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"Errors":>7}')
+        results = []
+        for width, height in IMAGE_SIZES:
+            for image_format in IMAGE_FORMATS:
+                data = create_image(width, height, image_format)
+                name = f'resnet50 {image_format} {width}x{height}'
+                if len(image_request(data).data) > MAX_UPLOAD_BYTES:
+                    size_mb = len(data) / 1024 / 1024
+                    print(f'{name:<32} skipped, {size_mb:.2f} MB is rejected by the upload limit')
+                    results.append({'test': name, 'skipped': 'rejected by the upload limit', 'bytes': len(data)})
+                    continue
+                for concurrency in CONCURRENCY_LEVELS:
+                    results.append(run_test(name, lambda n: image_request(data), concurrency))
+        for use_fields in [False, True]:
+            name = 'pima ' + ('fields' if use_fields else 'values')
+            for concurrency in CONCURRENCY_LEVELS:
+                create = lambda n: pima_request(PIMA_RECORDS[n % len(PIMA_RECORDS)], use_fields)
+                results.append(run_test(name, create, concurrency))
+        print('-' * 80)
+
+        # Save Results
+        memory = process_memory(pid) if pid else []
+        for n, process in enumerate(memory):
+            label = 'Server' if n == 0 else 'Worker'
+            print(f'{label} {process["pid"]}: Peak RSS {process["peak_rss_mb"]} MB, Pss {process["pss_mb"]} MB')
+        total_pss = round(sum(process['pss_mb'] or 0 for process in memory), 1) if memory else None
+        print(f'Total Pss: {total_pss} MB')
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'base_url': BASE_URL,
+            'requests_per_test': REQUESTS_PER_TEST,
+            'bypass_prediction_cache': BYPASS_PREDICTION_CACHE,
+            'memory': memory,
+            'total_pss_mb': total_pss,
+            'results': results,
+        }
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, 'benchmark-{0}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+        with open(path, 'w') as f:
+            f.write(json.dumps(report, indent=4))
+        print(f'Saved results to: {path}')
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+#-------------------------------------------------
+# Start of Script
+#-------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,26 @@
 # Simple script to test the model file created by [ai-ml-pima-indians-diabetes-build.py]
+# The JSON file is scored using [LogisticModel] from [app/logistic_model.py] which
+# only requires NumPy. If sklearn is installed then results are also compared to sklearn.
 import os
+import sys
 import pickle
-import json
 import numpy as np
-from sklearn.linear_model import LogisticRegression
+
+# Load [logistic_model.py] from the [app] directory
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(cur_dir, '..', 'app'))
+from logistic_model import LogisticModel
 
 # Two options exist for the saved file format, see [ai-ml-pima-indians-diabetes-convert-model.py]
 USE_JSON_FILE = True
 
 # File Location
-cur_dir = os.path.dirname(os.path.abspath(__file__))
 file_name = 'pima-indians-diabetes.json' if USE_JSON_FILE else 'pima-indians-diabetes.sklearn'
 model_path = os.path.join(cur_dir, file_name)
 
 # Open file
 if USE_JSON_FILE:
-    with open(model_path, 'r') as file:
-        data = json.load(file)
-    model = LogisticRegression(data['params'])
-    for name, value in data.items():
-        if name.endswith('_'):
-            setattr(model, name, np.array(value))
+    model = LogisticModel.from_json(model_path)
 else:
     with open(model_path, 'rb') as file:
         model = pickle.load(file)
@@ -44,3 +44,22 @@ test_records = [
 ]
 print(model.predict(test_records))
 print(model.predict_proba(test_records)[:,1])
+
+# Compare with sklearn using all records from the CSV file (if available)
+csv_path = os.path.join(cur_dir, '..', 'app_data', 'pima-indians-diabetes.csv')
+if USE_JSON_FILE and os.path.exists(csv_path):
+    try:
+        from sklearn.linear_model import LogisticRegression
+    except ImportError:
+        LogisticRegression = None
+    if LogisticRegression is not None:
+        print('-' * 80)
+        sk_model = LogisticRegression()
+        sk_model.coef_ = model.coef_
+        sk_model.intercept_ = model.intercept_
+        sk_model.classes_ = model.classes_
+        records = np.loadtxt(csv_path, delimiter=',')[:, :-1]
+        same_predictions = np.array_equal(model.predict(records), sk_model.predict(records))
+        max_diff = np.max(np.abs(model.predict_proba(records) - sk_model.predict_proba(records)))
+        print(f'Compared {len(records)} records with sklearn')
+        print(f'Same predictions: {same_predictions}, Max probability difference: {max_diff}')
@@ -0,0 +1,115 @@
+"""
+Compare the ResNet50 CPU backends from [RESNET50_BACKENDS] in [app/app.py].
+
+For each backend this script builds the model, checks parity of the top-5
+labels against the 'eager' backend using [app.resnet50_parity()] on a fixture
+set of images, and measures latency and memory. Use the results to select the
+fastest backend that still returns correct results and then set
+[RESNET50_BACKEND] in [app.py].
+
+Fixture images are read from [REFERENCE_IMAGE_DIR] (JPEG or PNG). If the
+directory does not exist then random tensors are used which is enough to
+compare latency but real photos should be used to verify parity.
+
+Running:
+    python3 ai-ml-resnet50-backends.py
+
+Results are printed and saved to [REPORT_FILE] in JSON format.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import statistics
+import torch
+
+# Script Parameters
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+REFERENCE_IMAGE_DIR = os.path.join(CUR_DIR, '..', 'app_data', 'ai-ml', 'images')
+REPORT_FILE = os.path.join(CUR_DIR, 'ai-ml-resnet50-backends.json')
+RANDOM_IMAGE_COUNT = 16
+BATCH_SIZES = [1, 8]
+LOOP_COUNT = 10
+
+# Load [app.py] from the [app] directory
+sys.path.insert(0, os.path.join(CUR_DIR, '..', 'app'))
+import app
+app.wait_for_models()
+
+
+def rss_mb():
+    """ Current Resident Set Size of this process in MB (Linux) """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def fixture_images():
+    """ Return a single tensor batch of preprocessed images """
+    tensors = []
+    if os.path.isdir(REFERENCE_IMAGE_DIR):
+        for name in sorted(os.listdir(REFERENCE_IMAGE_DIR)):
+            if name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                with open(os.path.join(REFERENCE_IMAGE_DIR, name), 'rb') as f:
+                    img = app.load_image(f.read())
+                img = app.jpeg_draft(img, 256).convert('RGB')
+                tensors.append(app.preprocess_resnet50(img))
+    if tensors:
+        return torch.stack(tensors)
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(RANDOM_IMAGE_COUNT, 3, 224, 224, generator=generator)
+
+
+def latency_ms(model, batch_size):
+    """ Median time in milliseconds for a single forward pass """
+    x = torch.zeros(batch_size, 3, 224, 224)
+    times = []
+    with torch.no_grad():
+        model(x)
+        for _ in range(LOOP_COUNT):
+            start = time.perf_counter()
+            model(x)
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+images = fixture_images()
+reference = app.build_resnet50('eager')
+results = []
+for backend in app.RESNET50_BACKENDS:
+    gc.collect()
+    rss_before = rss_mb()
+    model = app.build_resnet50(backend)
+    rss_after = rss_mb()
+    result = {
+        'backend': backend,
+        'memory_mb': (round(rss_after - rss_before, 1) if rss_before is not None else None),
+        **app.resnet50_parity(reference, model, images),
+    }
+    for batch_size in BATCH_SIZES:
+        result[f'batch_{batch_size}_ms'] = round(latency_ms(model, batch_size), 2)
+    results.append(result)
+    del model
+
+# Print Report
+print('-' * 80)
+columns = ['backend', 'top1_match', 'top5_match', 'memory_mb'] + [f'batch_{size}_ms' for size in BATCH_SIZES]
+print(' '.join(f'{column:>18}' for column in columns))
+for result in results:
+    print(' '.join(f'{str(result[column]):>18}' for column in columns))
+print('-' * 80)
+print(f'Images: {len(images)}, Loops: {LOOP_COUNT}, Threads: {torch.get_num_threads()}')
+correct = [r for r in results if r['top1_match'] == r['images'] and r['top5_match'] == r['images']]
+if correct:
+    fastest = min(correct, key=lambda r: r[f'batch_{BATCH_SIZES[0]}_ms'])
+    print(f'Fastest backend with matching top-5 labels: {fastest["backend"]}')
+
+with open(REPORT_FILE, 'w') as f:
+    f.write(json.dumps(results, indent=4))
+print(f'Saved report to: {REPORT_FILE}')
@@ -0,0 +1,140 @@
+"""
+Benchmark for the image preprocessing used by [app/app.py] for ResNet50 (PyTorch).
+
+The original version of [resnet50_prediction()] created the image transforms
+on every request and decoded every JPEG at full resolution before resizing to
+256 pixels. The current version [image_prediction()] creates the transforms once and uses JPEG
+draft mode so that large images are decoded at a reduced scale.
+
+This script runs both versions over a set of reference images, verifies that
+the top-1 label from the model is the same for both versions, and prints the
+average preprocessing time per image for each version.
+
+Reference photos are read from [REFERENCE_IMAGE_DIR] (JPEG or PNG) and the
+script exits with an error if the directory is missing or has no images.
+The photos included with the site are 640x427 so they are smaller than the
+size where draft mode is used. For each reference photo the script also
+creates an upscaled JPEG copy with a shortest side of [UPSCALED_SHORT_SIDE]
+pixels (at least 1024 = 256 x 2 x [JPEG_DRAFT_MIN_SCALE]) so that draft mode is
+tested as well; the [Draft] column shows which images were decoded at a
+reduced scale. The script exits with an error if any top-1 result does not
+match or if no image used draft mode.
+
+Running (the model is loaded from [app.py] so it takes a few seconds to start):
+    python3 ai-ml-resnet50-preprocess-benchmark.py
+"""
+import os
+import io
+import sys
+import time
+import torch
+from PIL import Image
+from torchvision import transforms
+
+# Script Parameters
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+REFERENCE_IMAGE_DIR = os.path.join(CUR_DIR, '..', 'app_data', 'ai-ml', 'images')
+LOOP_COUNT = 5
+UPSCALED_SHORT_SIDE = 2048
+UPSCALED_JPEG_QUALITY = 95
+
+# Load [app.py] from the [app] directory
+sys.path.insert(0, os.path.join(CUR_DIR, '..', 'app'))
+import app
+app.wait_for_models()
+
+
+def original_preprocess(data):
+    """ Code from the original version of [resnet50_prediction()] """
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    preprocess = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    return preprocess(img)
+
+
+def current_preprocess(data):
+    """ Code used by the current version of [image_prediction()] """
+    img = app.load_image(data)
+    img = app.jpeg_draft(img, 256).convert('RGB')
+    return app.preprocess_resnet50(img)
+
+
+def reference_images():
+    """ Return a list of (name, bytes) for all test images """
+    images = []
+    if os.path.isdir(REFERENCE_IMAGE_DIR):
+        for name in sorted(os.listdir(REFERENCE_IMAGE_DIR)):
+            if name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                with open(os.path.join(REFERENCE_IMAGE_DIR, name), 'rb') as f:
+                    images.append((name, f.read()))
+    if not images:
+        print(f'Error - No JPEG or PNG images found in [{os.path.realpath(REFERENCE_IMAGE_DIR)}]')
+        sys.exit(1)
+    return images + [upscaled_jpeg(name, data) for name, data in images]
+
+
+def upscaled_jpeg(name, data):
+    """ Return (name, bytes) for a JPEG copy of an image resized to [UPSCALED_SHORT_SIDE] """
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    scale = UPSCALED_SHORT_SIDE / min(img.size)
+    size = (round(img.width * scale), round(img.height * scale))
+    buffer = io.BytesIO()
+    img.resize(size, Image.BICUBIC).save(buffer, 'JPEG', quality=UPSCALED_JPEG_QUALITY)
+    return (f'{os.path.splitext(name)[0]}-{size[0]}x{size[1]}.jpg', buffer.getvalue())
+
+
+def uses_draft(data):
+    """ Return True if [app.jpeg_draft()] decodes the image at a reduced scale """
+    img = app.load_image(data)
+    size = img.size
+    return app.jpeg_draft(img, 256).size != size
+
+
+def top1(tensor):
+    with torch.no_grad():
+        return int(app.model_resnet50(tensor.unsqueeze(0).to(app.device))[0].argmax())
+
+
+def average_seconds(func, data):
+    start = time.perf_counter()
+    for _ in range(LOOP_COUNT):
+        func(data)
+    return (time.perf_counter() - start) / LOOP_COUNT
+
+
+images = reference_images()
+print('-' * 86)
+print(f'{"Image":<40} {"Original ms":>12} {"Current ms":>12} {"Draft":>6} {"Top-1 Match":>12}')
+total_original = 0
+total_current = 0
+mismatch_count = 0
+draft_count = 0
+for name, data in images:
+    original = average_seconds(original_preprocess, data)
+    current = average_seconds(current_preprocess, data)
+    match = top1(original_preprocess(data)) == top1(current_preprocess(data))
+    if not match:
+        mismatch_count += 1
+    draft = uses_draft(data)
+    if draft:
+        draft_count += 1
+    total_original += original
+    total_current += current
+    print(f'{name:<40} {original * 1000:>12.2f} {current * 1000:>12.2f} {str(draft):>6} {str(match):>12}')
+
+print('-' * 86)
+count = len(images)
+print(f'Images: {count}, Draft Mode Images: {draft_count}, Loops: {LOOP_COUNT}, JPEG Draft: {app.USE_JPEG_DRAFT}')
+print(f'Average per request - Original: {total_original / count * 1000:.2f} ms, Current: {total_current / count * 1000:.2f} ms')
+print(f'Average time saved per request: {(total_original - total_current) / count * 1000:.2f} ms')
+print(f'Top-1 mismatches: {mismatch_count}')
+if mismatch_count > 0:
+    print('Error - Top-1 results do not match for all images')
+    sys.exit(1)
+if draft_count == 0:
+    print(f'Error - No images used draft mode (JPEG Draft: {app.USE_JPEG_DRAFT}) so draft mode was not tested')
+    sys.exit(1)
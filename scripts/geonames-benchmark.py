@@ -0,0 +1,260 @@
+"""
+Query benchmark for the Geonames SQLite database created by [geonames.py].
+
+Each geonames SQL file in [app/SQL] is replayed with parameters sampled from
+the database so that tests cover a realistic spread of countries, regions,
+place names, search prefixes, and coordinates rather than a single value.
+For every file this script checks [EXPLAIN QUERY PLAN] for full table scans
+and reports p50/p95/p99 latency. Use it to compare index, [PAGE_SIZE], and
+[RUN_VACUUM] options in [geonames.py] or after changing a SQL file.
+
+A full scan is any [SCAN] of a table or index other than a virtual table
+(FTS5 and R*Tree plans always show [SCAN]) or a table in [SMALL_TABLES].
+SQL files that do not have a parameter sampler are listed as skipped and
+files for an index that was not created (for example the full-text search
+index) are skipped. The script exits with status 1 if a full scan is found.
+
+Results are printed and saved in JSON format to [RESULTS_DIR].
+
+Running:
+    python3 geonames-benchmark.py
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import importlib.util
+import sqlite3
+import statistics
+from datetime import datetime
+
+# Script Parameters
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLITE_FILE = os.path.realpath(os.path.join(CUR_DIR, '..', 'app_data', 'geonames.sqlite'))
+SQL_DIR = os.path.realpath(os.path.join(CUR_DIR, '..', 'app', 'SQL'))
+RESULTS_DIR = os.path.join(CUR_DIR, 'benchmark-results')
+QUERIES_PER_FILE = 200
+WARMUP_QUERIES = 20
+RANDOM_SEED = 0
+SMALL_TABLES = ['countries']
+
+# Query parameters are built by [app/geonames.py] so that the
+# benchmark uses the same queries as the web service. The file is loaded
+# by path under a different module name because this script is also named
+# [geonames] (scripts/geonames.py) and [app] is not a package.
+spec = importlib.util.spec_from_file_location('app_geonames', os.path.join(CUR_DIR, '..', 'app', 'geonames.py'))
+app_geonames = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app_geonames)
+search_prefix_query = app_geonames.search_prefix_query
+distance_params = app_geonames.distance_params
+
+# Feature codes excluded by the city queries, used to sample places
+HISTORICAL_CODES = ('PPLCH', 'PPLH', 'PPLQ', 'PPLW')
+
+
+def sample_places(db, rng, count, feature_class=None):
+    """
+    Random rows from [geonames] found by [rowid] so the table is not scanned.
+    Returns up to [count] tuples of (name, country_code, admin1_code, latitude, longitude).
+    """
+    min_rowid, max_rowid = db.execute('SELECT MIN(rowid), MAX(rowid) FROM geonames').fetchone()
+    # [rowid] is [geonames_id] for the compact schema so there are gaps between rows
+    sql = 'SELECT name, country_code, admin1_code, latitude, longitude, feature_class, feature_code FROM geonames WHERE rowid >= ? ORDER BY rowid LIMIT 1'
+    places = []
+    for _ in range(count * 50):
+        if len(places) == count or max_rowid is None:
+            break
+        row = db.execute(sql, (rng.randint(min_rowid, max_rowid),)).fetchone()
+        if row is None or (feature_class is not None and row[5] != feature_class) or row[6] in HISTORICAL_CODES:
+            continue
+        places.append(row[:5])
+    return places
+
+
+def country_codes(db):
+    return [row[0] for row in db.execute('SELECT iso FROM countries')]
+
+
+def capitals(db):
+    """ Country capitals, the most commonly searched places """
+    return [(row[0], row[1]) for row in db.execute("SELECT capital, iso FROM countries WHERE capital <> ''")]
+
+
+#-------------------------------------------------
+# Parameter samplers, one for each SQL file. Each returns
+# a list of parameters to use with the SQL.
+#-------------------------------------------------
+
+def params_countries(db, rng, count):
+    return [()] * count
+
+
+def params_admin1_by_country(db, rng, count):
+    codes = country_codes(db)
+    return [(rng.choice(codes),) for _ in range(count)]
+
+
+def params_largest_cities(db, rng, count):
+    # Regions of random places so larger regions with more places are used more often
+    return [(place[1], place[2]) for place in sample_places(db, rng, count)]
+
+
+def params_search(db, rng, count):
+    # Half capitals and half random place names, half of each with a country
+    names = capitals(db)
+    names = [rng.choice(names) for _ in range(count // 2)]
+    names += [(place[0], place[1]) for place in sample_places(db, rng, count - len(names), 'P')]
+    return [{'name': name, 'country_code': (country if rng.random() < 0.5 else '')} for name, country in names]
+
+
+def params_search_prefix(db, rng, count):
+    # Prefixes of 2 to 6 characters as typed in an autocomplete field
+    names = capitals(db)
+    names = [rng.choice(names) for _ in range(count // 2)]
+    names += [(place[0], place[1]) for place in sample_places(db, rng, count - len(names), 'P')]
+    params = []
+    for name, country in names:
+        query = search_prefix_query(name[:rng.randint(2, 6)], (country if rng.random() < 0.5 else ''))
+        if query is not None:
+            params.append({'query': query})
+    return params
+
+
+def params_nearby(db, rng, count):
+    params = []
+    for place in sample_places(db, rng, count):
+        p = distance_params(place[3], place[4], rng.choice([25, 100, 400]))
+        p.update({'latitude': place[3], 'longitude': place[4], 'feature_class': rng.choice(['P', 'P', 'A', '']), 'limit': 20})
+        params.append(p)
+    return params
+
+
+def params_bounding_box(db, rng, count):
+    params = []
+    for place in sample_places(db, rng, count):
+        p = distance_params(place[3], place[4], rng.choice([5, 50, 250]))
+        p['feature_class'] = rng.choice(['P', 'P', 'A', ''])
+        params.append(p)
+    return params
+
+
+# SQL file name, parameter sampler, required table
+SQL_FILES = [
+    ('geonames-countries.sql', params_countries, 'countries'),
+    ('geonames-admin1-by-country.sql', params_admin1_by_country, 'geonames'),
+    ('geonames-20-largest-cities-in-admin1.sql', params_largest_cities, 'geonames'),
+    ('geonames-search.sql', params_search, 'geonames'),
+    ('geonames-search-prefix.sql', params_search_prefix, 'geonames_search'),
+    ('geonames-nearby.sql', params_nearby, 'geonames_rtree'),
+    ('geonames-bounding-box.sql', params_bounding_box, 'geonames_rtree'),
+]
+
+
+def full_scans(db, sql, params):
+    """ Return plan lines from [EXPLAIN QUERY PLAN] that scan a full table or index """
+    scans = []
+    for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params):
+        detail = row[3]
+        match = re.match(r'SCAN (\w+)', detail)
+        if match is None or 'VIRTUAL TABLE' in detail:
+            continue
+        table = match.group(1)
+        aliases = re.findall(r'(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.IGNORECASE)
+        tables = {alias or name: name for name, alias in aliases}
+        if tables.get(table, table) not in SMALL_TABLES:
+            scans.append(detail)
+    return scans
+
+
+def run_test(db, name, sql, params_list):
+    """ Run each query, return stats """
+    plan = [row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params_list[0])]
+    scans = full_scans(db, sql, params_list[0])
+    for params in params_list[:WARMUP_QUERIES]:
+        db.execute(sql, params).fetchall()
+    latencies = []
+    rows = 0
+    for params in params_list:
+        start = time.perf_counter()
+        rows += len(db.execute(sql, params).fetchall())
+        latencies.append((time.perf_counter() - start) * 1000)
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    result = {
+        'test': name,
+        'queries': len(latencies),
+        'avg_rows': round(rows / len(latencies), 1),
+        'p50_ms': round(percentiles[49], 3),
+        'p95_ms': round(percentiles[94], 3),
+        'p99_ms': round(percentiles[98], 3),
+        'full_scans': scans,
+        'plan': plan,
+    }
+    print(f'{name:<44} {result["queries"]:>7} {result["avg_rows"]:>8} {result["p50_ms"]:>9} {result["p95_ms"]:>9} {result["p99_ms"]:>9} {"FULL SCAN" if scans else "ok":>10}')
+    return result
+
+
+def main():
+    if not os.path.isfile(SQLITE_FILE):
+        print('Error - File [{0}] does not exist, run [geonames.py] first'.format(SQLITE_FILE))
+        sys.exit(1)
+    db = sqlite3.connect('file:{0}?mode=ro'.format(SQLITE_FILE), uri=True)
+    tables = set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    rng = random.Random(RANDOM_SEED)
+
+    print('-' * 96)
+    print(f'{"SQL File":<44} {"Queries":>7} {"Rows":>8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"Plan":>10}')
+    results = []
+    skipped = []
+    for file_name, sampler, table in SQL_FILES:
+        if table not in tables:
+            skipped.append(f'{file_name} (missing table [{table}])')
+            continue
+        with open(os.path.join(SQL_DIR, file_name), 'r', encoding='utf-8') as f:
+            sql = f.read()
+        params_list = sampler(db, rng, QUERIES_PER_FILE)
+        if not params_list:
+            skipped.append(f'{file_name} (no data)')
+            continue
+        results.append(run_test(db, file_name, sql, params_list))
+        # Countries sorted by name, see [Geonames::getCountries()] in PHP
+        if file_name == 'geonames-countries.sql':
+            results.append(run_test(db, file_name + ' (order_by=country)', sql.replace('population DESC,', ''), params_list))
+    tested = set(file_name for file_name, _, _ in SQL_FILES)
+    for file_name in sorted(os.listdir(SQL_DIR)):
+        if file_name.startswith('geonames') and file_name not in tested:
+            skipped.append(f'{file_name} (no parameter sampler)')
+    print('-' * 96)
+    for name in skipped:
+        print(f'Skipped: {name}')
+
+    # Save Results
+    scans = [result for result in results if result['full_scans']]
+    for result in scans:
+        print(f'Full scan in [{result["test"]}]: {"; ".join(result["full_scans"])}')
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'sqlite_file': SQLITE_FILE,
+        'file_size_mb': round(os.path.getsize(SQLITE_FILE) / 1024 / 1024, 1),
+        'page_size': db.execute('PRAGMA page_size').fetchone()[0],
+        'sqlite_version': sqlite3.sqlite_version,
+        'analyzed': 'sqlite_stat1' in tables,
+        'queries_per_file': QUERIES_PER_FILE,
+        'results': results,
+        'skipped': skipped,
+    }
+    db.close()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, 'geonames-benchmark-{0}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w') as f:
+        f.write(json.dumps(report, indent=4))
+    print(f'Saved results to: {path}')
+    if scans:
+        sys.exit(1)
+
+#-------------------------------------------------
+# Start of Script
+#-------------------------------------------------
+if __name__ == '__main__':
+    main()
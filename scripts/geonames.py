@@ -20,21 +20,68 @@
     http://www.geonames.org/
     http://download.geonames.org/export/dump/
         From the above link download [allCountries.zip] and [countryInfo.txt].
-        Unzip [allCountries.zip] prior to running this script.
+        Records are read directly from [allCountries.zip] so it does not need to
+        be unzipped. If [allCountries.txt] was already extracted it is used instead.
     http://download.geonames.org/export/dump/readme.txt
     https://www.sqlite.org/index.html
 
-    This script is expected to take about 3 to 5 minutes to run.
+    Rows from [allCountries.txt] are parsed by worker processes. The file is
+    split into byte ranges of [CHUNK_BYTES] that end on a line break and each
+    worker saves the rows from its range to a temporary SQLite file. The main
+    process copies each temporary file into the database in file order using
+    [INSERT INTO ... SELECT] and commits after each chunk, so rows are imported
+    in the same order and the table content is the same as a single-threaded
+    import while Python only parses and binds values in the workers.
+
+    This script is expected to take about 3 to 5 minutes to run with a single
+    worker and the time for parsing is divided by the number of CPU cores.
 
     Expected Results:
     Added 252 Records to [countries] Table
     Added 11768184 Records to [geonames] Table
     Success Database Created
+
+    Incremental Updates:
+    GeoNames publishes daily change files that can be applied to an existing
+    database rather than importing all records again. Download the files for
+    each day since the database was created to [UPDATES_DIR] and run:
+        python3 geonames.py update
+
+    http://download.geonames.org/export/dump/modifications-YYYY-MM-DD.txt
+    http://download.geonames.org/export/dump/deletes-YYYY-MM-DD.txt
+    http://download.geonames.org/export/dump/alternateNamesModifications-YYYY-MM-DD.txt
+    http://download.geonames.org/export/dump/alternateNamesDeletes-YYYY-MM-DD.txt
+
+    Records from [modifications] files are added or updated and records from
+    [deletes] files are deleted using [geonames_id]. Alternate name files add
+    or remove a name from the [alternate_names] column. Each file is applied in a
+    single transaction and saved to the [geonames_updates] table so files are
+    only applied once and files older than the full import are skipped. Updates
+    use SQLite WAL mode so the site can read from the database while an update
+    is running (the web server needs write access to the directory of the
+    database for the [-wal] and [-shm] files). Alternate name files only include
+    the alternate name id so a modified name is added but the previous spelling
+    is not removed; run a full import from time to time to remove these.
 """
+import io
+import itertools
 import os
+import sys
+import gzip
+import json
+import hashlib
+import re
+import time
+import shutil
 import sqlite3
+import zipfile
+import tempfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 
-# File Settings
+# File Settings. If a file does not exist then it is read from a zip file with
+# the same name, for example [allCountries.txt] is read from [allCountries.zip].
 CUR_DIR = os.path.dirname(__file__)
 PLACES_FILE = 'allCountries.txt'
 COUNTRIES_FILE = 'countryInfo.txt'
@@ -45,22 +92,144 @@ SAVE_DIR = os.path.realpath(os.path.join(CUR_DIR, '..', 'app_data'))
 # SAVE_DIR = '/Users/conrad/Sites/geonames'
 SQLITE_FILE = os.path.join(SAVE_DIR, 'geonames.sqlite')
 
+# Directory with daily change files for [python3 geonames.py update]
+UPDATES_DIR = CUR_DIR
+
 # Options
 RECREATE_SQLITE_DB = True
 
+# Import Options
+#   [PARSE_WORKERS] - Number of worker processes, [None] uses one per CPU core.
+#                     Use [1] to parse in the main process without workers.
+#   [CHUNK_BYTES]   - Size of each part of [PLACES_FILE] parsed by a worker. This is
+#                     also the size of each transaction. At most [PARSE_WORKERS * 2]
+#                     chunks are parsed ahead of the import so that memory and temp
+#                     file use are bounded.
+#   [INDEX_MODE]    - 'after'  - Create indexes once all rows are imported (fastest).
+#                     'during' - Create indexes before the import so that the index is
+#                                built while workers continue parsing the file.
+PARSE_WORKERS = None
+CHUNK_BYTES = 16 * 1024 * 1024
+INDEX_MODE = 'after'
+
+# Full-text Search Index used by [app/SQL/geonames-search-prefix.sql]. Names, ASCII
+# names, and alternate names are indexed with FTS5 so that searches can match the
+# start of any word ("san fr" finds "San Francisco") and ignore accents ("sao"
+# finds "São Paulo"). The [rowid] of each search record is the rank of the place
+# by population so results are returned in population order and a search with a
+# LIMIT stops once enough places are found rather than sorting all matches. The
+# FTS5 table is contentless so names are not stored a second time. The index adds
+# several minutes to the import and about 1 GB to the database for all records.
+CREATE_SEARCH_INDEX = True
+
+# Spatial Index used by [app/SQL/geonames-nearby.sql] and [geonames-bounding-box.sql].
+# An R*Tree index of the coordinates of each place is used to find places inside
+# a bounding box without scanning the [geonames] table. [feature_class] is saved
+# as an auxiliary column of the R*Tree so places can be filtered by class before
+# the [geonames] table is read. R*Tree coordinates are 32-bit floats and are
+# rounded outwards so places are not missed, distances are calculated from the
+# original values in the [geonames] table.
+CREATE_SPATIAL_INDEX = True
+
+# Database Tuning
+#   [PAGE_SIZE]   - Page size in bytes for the new database, [None] uses the SQLite
+#                   default (4096). Larger pages (8192 or 16384) make the file
+#                   slightly smaller and use fewer reads for the large [geonames]
+#                   indexes; use [scripts/geonames-benchmark.py] to compare.
+#   [RUN_ANALYZE] - Run [ANALYZE] once all indexes are created so the query planner
+#                   has statistics for each index. [PRAGMA optimize] is also run
+#                   after [python3 geonames.py update] so statistics stay current.
+#   [RUN_VACUUM]  - Rebuild the database once the import is complete. Indexes created
+#                   after the import are already compact so this mostly helps when
+#                   [INDEX_MODE = 'during'] is used; it can also be run manually with
+#                   the [sqlite3] CLI after many updates. Adds several minutes and needs
+#                   free disk space equal to the size of the database.
+PAGE_SIZE = None
+RUN_ANALYZE = True
+RUN_VACUUM = False
+
+# Compact Schema. When [True] the [geonames] table is created with a smaller layout:
+#   - [geonames_id] is an [INTEGER PRIMARY KEY] (the rowid) so there is no separate
+#     primary key index and lookups by id read a single b-tree.
+#   - Standard column types (INTEGER, REAL, TEXT). Values are saved the same as the
+#     original layout (empty values are empty strings) so query results match.
+#   - Columns used by the search and city queries are stored first in each record.
+#   - [alternate_names] is moved to the [geonames_alternate_names] table. The names
+#     are large for many places and are only used by the place page and the search
+#     index so more [geonames] rows fit in each page and in the page cache.
+# The queries in [app/SQL] and [Geonames::getPlace()] in PHP work with either layout
+# and [python3 geonames.py update] uses the layout of the existing database. The
+# import prints the file size and rows per page of [geonames], import once with
+# each setting to compare.
+COMPACT_SCHEMA = False
+
+# Columns of [PLACES_FILE] and of the compact [geonames] table
+GEONAMES_COLUMNS = ['geonames_id', 'name', 'ascii_name', 'alternate_names', 'latitude', 'longitude', 'feature_class', 'feature_code', 'country_code', 'cc2', 'admin1_code', 'admin2_code', 'admin3_code', 'admin4_code', 'population', 'elevation', 'dem', 'timezone', 'modification_date']
+COMPACT_COLUMNS = ['geonames_id', 'country_code', 'admin1_code', 'feature_class', 'feature_code', 'population', 'name', 'latitude', 'longitude', 'timezone', 'elevation', 'ascii_name', 'cc2', 'admin2_code', 'admin3_code', 'admin4_code', 'dem', 'modification_date']
+
+# Static Snapshots. When [True] the results of the countries, regions, and cities
+# routes in [app/routes-data.php] are saved as gzip compressed JSON files so the
+# web server can return them without querying the database. Files are created
+# with the SQL from [SQL_DIR] after the import and again after updates, or at any
+# time with [python3 geonames.py snapshots]. [manifest.json] lists the route, file,
+# and ETag (MD5 of the compressed file) of each snapshot for use by a static file
+# server or CDN. When [False] an existing [SNAPSHOT_DIR] is deleted by the import
+# and by updates so the web server does not return data from before the change.
+# Layout of [SNAPSHOT_DIR]:
+#     countries.json.gz             /data/geonames/countries
+#     countries-by-country.json.gz  /data/geonames/countries?order_by=country
+#     regions/{country}.json.gz     /data/geonames/regions/:country
+#     cities/{country}/{region}.json.gz
+CREATE_SNAPSHOTS = False
+SNAPSHOT_DIR = os.path.join(SAVE_DIR, 'geonames-snapshots')
+SQL_DIR = os.path.realpath(os.path.join(CUR_DIR, '..', 'app', 'SQL'))
+
+# Change Files, in the order they are applied for each day
+UPDATE_FILE_TYPES = ['modifications', 'deletes', 'alternateNamesModifications', 'alternateNamesDeletes']
+UPDATE_FILE_PATTERN = re.compile(r'^({0})-(\d{{4}}-\d{{2}}-\d{{2}})\.txt$'.format('|'.join(UPDATE_FILE_TYPES)))
+
+# Alternate names of these types (links, postal codes, etc) are
+# not included in the [alternate_names] column of [allCountries.txt]
+SKIP_ALTERNATE_NAME_TYPES = ['link', 'post', 'wkdt', 'unlc', 'iata', 'icao', 'faac', 'abbr', 'fr_1793']
+
 # Globals
 record_count = 0
 
+# Part of a Places File, either a byte range of an extracted
+# file [path, start, end] or the decompressed [data] from a zip file
+PlacesChunk = namedtuple('PlacesChunk', 'path start end data')
+
 #-------------------------------------------------
 # Functions
 #-------------------------------------------------
 
+def data_file(file_name):
+    """
+    Return (path, zip member name) for a data file. [member] is [None] if the
+    file exists otherwise the path of a zip file with the same name is returned.
+    """
+    path = os.path.join(CUR_DIR, file_name)
+    if os.path.isfile(path):
+        return path, None
+    zip_path = os.path.splitext(path)[0] + '.zip'
+    if os.path.isfile(zip_path):
+        return zip_path, os.path.basename(file_name)
+    raise FileNotFoundError('File [{0}] or [{1}] not found'.format(path, zip_path))
+
+def open_data_file(file_name, encoding=None):
+    """ Open a data file as text, reading from a zip file if needed """
+    path, member = data_file(file_name)
+    if member is None:
+        return open(path, encoding=encoding)
+    with zipfile.ZipFile(path) as z:
+        # The zip file stays open until the member is closed
+        return io.TextIOWrapper(z.open(member), encoding=encoding)
+
 def countries_generator():
     """ Read the Geonames Countries File and yield each record """
     global record_count
     record_count = 0
-    path = os.path.join(CUR_DIR, COUNTRIES_FILE)
-    with open(path) as f:
+    with open_data_file(COUNTRIES_FILE) as f:
         for line in f:
             line = line.rstrip('\n')
             if line != '' and not line.startswith('#'):
@@ -72,14 +241,580 @@ def places_generator():
     """ Read a Geonames Places File and yield each record """
     global record_count
     record_count = 0
-    path = os.path.join(CUR_DIR, PLACES_FILE)
+    for chunk in places_chunks(CHUNK_BYTES):
+        for values in places_rows(read_places_chunk(chunk)):
+            record_count += 1
+            yield values
+
+def places_chunks(chunk_bytes):
+    """
+    Split [PLACES_FILE] into parts that end on a line break. For an extracted
+    file only the byte range is returned and the file is read by the worker.
+    For a zip file the data is streamed from the zip file without extracting it.
+    """
+    path, member = data_file(PLACES_FILE)
+    if member is None:
+        size = os.path.getsize(path)
+        start = 0
+        with open(path, 'rb') as f:
+            while start < size:
+                f.seek(min(start + chunk_bytes, size))
+                f.readline()
+                end = min(f.tell(), size)
+                yield PlacesChunk(path, start, end, None)
+                start = end
+        return
+    with zipfile.ZipFile(path) as z, z.open(member) as f:
+        start = 0
+        remainder = b''
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            data = remainder + block
+            cut = data.rfind(b'\n') + 1
+            remainder = data[cut:]
+            if cut > 0:
+                yield PlacesChunk(None, start, start + cut, data[:cut])
+                start += cut
+        if remainder:
+            yield PlacesChunk(None, start, start + len(remainder), remainder)
+
+def places_file_size():
+    """ Size of the uncompressed Places File, used to show progress """
+    path, member = data_file(PLACES_FILE)
+    if member is None:
+        return os.path.getsize(path)
+    with zipfile.ZipFile(path) as z:
+        return z.getinfo(member).file_size
+
+def read_places_chunk(chunk):
+    """ Return the bytes for a [PlacesChunk] """
+    if chunk.data is not None:
+        return chunk.data
+    with open(chunk.path, 'rb') as f:
+        f.seek(chunk.start)
+        return f.read(chunk.end - chunk.start)
+
+def places_rows(data):
+    """
+    Parse records from part of a Places File. Line breaks are handled the
+    same as reading the file in text mode ('\r\n' and '\r' are line breaks).
+    """
+    text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    return [line.split('\t') for line in text.split('\n') if line != '']
+
+def geonames_table_sql(table='geonames', primary_key=True):
+    """ SQL for the [geonames] table, also used for the temporary table of each chunk """
+    return """
+        CREATE TABLE {0} (
+            geonames_id INT{1},
+            name TEXT COLLATE NOCASE,
+            ascii_name TEXT,
+            alternate_names TEXT,
+            latitude DOUBLE,
+            longitude DOUBLE,
+            feature_class TEXT,
+            feature_code TEXT,
+            country_code TEXT,
+            cc2 TEXT,
+            admin1_code TEXT,
+            admin2_code TEXT,
+            admin3_code TEXT,
+            admin4_code TEXT,
+            population LONG,
+            elevation INT,
+            dem INT,
+            timezone TEXT,
+            modification_date TEXT
+        )
+    """.format(table, ' PRIMARY KEY' if primary_key else '')
+
+def compact_tables_sql():
+    """ SQL for the [geonames] and [geonames_alternate_names] tables, see [COMPACT_SCHEMA] """
+    return [
+        """
+        CREATE TABLE geonames (
+            geonames_id INTEGER PRIMARY KEY,
+            country_code TEXT,
+            admin1_code TEXT,
+            feature_class TEXT,
+            feature_code TEXT,
+            population INTEGER,
+            name TEXT COLLATE NOCASE,
+            latitude REAL,
+            longitude REAL,
+            timezone TEXT,
+            elevation INTEGER,
+            ascii_name TEXT,
+            cc2 TEXT,
+            admin2_code TEXT,
+            admin3_code TEXT,
+            admin4_code TEXT,
+            dem INTEGER,
+            modification_date TEXT
+        )
+        """,
+        """
+        CREATE TABLE geonames_alternate_names (
+            geonames_id INTEGER PRIMARY KEY,
+            alternate_names TEXT
+        )
+        """,
+    ]
+
+def import_chunk_sql():
+    """
+    SQL to copy rows from the temporary table of a chunk. For the compact schema
+    rows are sorted by [geonames_id] so that pages of the [INTEGER PRIMARY KEY]
+    table are filled in order.
+    """
+    if not COMPACT_SCHEMA:
+        return ['INSERT INTO geonames SELECT * FROM chunk.geonames']
+    return [
+        "INSERT INTO geonames ({0}) SELECT {1} FROM chunk.geonames ORDER BY geonames_id".format(
+            ', '.join(COMPACT_COLUMNS),
+            ', '.join(COMPACT_COLUMNS)),
+        "INSERT INTO geonames_alternate_names SELECT geonames_id, alternate_names FROM chunk.geonames WHERE alternate_names <> '' ORDER BY geonames_id",
+    ]
+
+def alternate_names_join():
+    """
+    Return (join, column) to read [alternate_names] for [geonames g] with
+    either the original or compact schema.
+    """
+    if COMPACT_SCHEMA:
+        return 'LEFT JOIN geonames_alternate_names a ON a.geonames_id = g.geonames_id', 'a.alternate_names'
+    return '', 'g.alternate_names'
+
+def has_table(cursor, name):
+    return cursor.execute('SELECT COUNT(*) FROM sqlite_master WHERE name = ?', (name,)).fetchone()[0] > 0
+
+def create_indexes(cursor):
+    """
+    Indexes for the queries in [app/SQL]. Columns after the [WHERE] equality
+    columns follow the [ORDER BY] so rows are read in sorted order and a query
+    with a [LIMIT] stops early rather than sorting every match. [feature_code]
+    is included so [NOT IN (...)] is checked from the index before a row is read.
+        country_feature        - geonames-admin1-by-country.sql
+        country_admin1_cities  - geonames-20-largest-cities-in-admin1.sql
+        place_names            - geonames-search.sql ([country_code] is optional
+                                 so it follows [population] rather than [name])
+    """
+    cursor.execute('CREATE INDEX country_feature ON geonames (country_code, feature_class, feature_code, name)')
+    cursor.execute('CREATE INDEX country_admin1_cities ON geonames (country_code, admin1_code, feature_class, population DESC, name, feature_code)')
+    cursor.execute('CREATE INDEX place_names ON geonames (name, feature_class, population DESC, country_code, timezone, feature_code)')
+
+def parse_places_chunk(chunk, temp_file):
+    """
+    Parse a [PlacesChunk] and save the rows to a temporary
+    SQLite file. This runs in a worker process.
+    Returns (temp_file, number of rows, end position).
+    """
+    rows = places_rows(read_places_chunk(chunk))
+    db = sqlite3.connect(temp_file)
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute(geonames_table_sql(primary_key=False))
+    db.executemany('INSERT INTO geonames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    db.commit()
+    db.close()
+    return temp_file, len(rows), chunk.end
+
+def parsed_chunks(chunks, workers, temp_dir):
+    """
+    Yield results from [parse_places_chunk()] in file order. Workers
+    parse up to [workers * 2] chunks ahead of the chunk being imported.
+    """
+    temp_files = (os.path.join(temp_dir, 'chunk-{0:05d}.sqlite'.format(n)) for n in itertools.count())
+    if workers <= 1:
+        for chunk in chunks:
+            yield parse_places_chunk(chunk, next(temp_files))
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(parse_places_chunk, chunk, next(temp_files)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def import_places(db):
+    """
+    Import [PLACES_FILE] to the [geonames] table. Rows are copied from the
+    temporary file of each chunk and committed once per chunk with progress
+    shown after each chunk.
+    """
+    global record_count
+    record_count = 0
+    size = places_file_size()
+    workers = PARSE_WORKERS or os.cpu_count() or 1
+    temp_dir = tempfile.mkdtemp(prefix='geonames-import-', dir=os.path.dirname(SQLITE_FILE))
+    start_time = time.time()
+    try:
+        chunks = places_chunks(CHUNK_BYTES)
+        for temp_file, count, end in parsed_chunks(chunks, workers, temp_dir):
+            db.execute('ATTACH DATABASE ? AS chunk', (temp_file,))
+            for sql in import_chunk_sql():
+                db.execute(sql)
+            db.commit()
+            db.execute('DETACH DATABASE chunk')
+            os.remove(temp_file)
+            record_count += count
+            seconds = max(time.time() - start_time, 0.001)
+            sys.stdout.write('\rImported {0:,} Records ({1:.0%}) at {2:,.0f} Records/sec'.format(record_count, end / size, record_count / seconds))
+            sys.stdout.flush()
+        print('')
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def create_search_index(cursor):
+    """ Create the full-text search index, see [CREATE_SEARCH_INDEX] """
+    cursor.execute('CREATE TABLE geonames_search_rank (rank INTEGER PRIMARY KEY, geonames_id INT)')
+    cursor.execute('INSERT INTO geonames_search_rank (geonames_id) SELECT geonames_id FROM geonames ORDER BY population DESC, geonames_id')
+    cursor.execute('CREATE INDEX geonames_search_rank_id ON geonames_search_rank (geonames_id)')
+    cursor.execute("""
+        CREATE VIRTUAL TABLE geonames_search USING fts5(
+            name,
+            ascii_name,
+            alternate_names,
+            country_code,
+            content = '',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO geonames_search (rowid, name, ascii_name, alternate_names, country_code)
+        SELECT r.rank, g.name, g.ascii_name, {1}, g.country_code
+        FROM geonames_search_rank r
+        INNER JOIN geonames g ON g.geonames_id = r.geonames_id
+        {0}
+        ORDER BY r.rank
+    """.format(*alternate_names_join()))
+    cursor.execute("INSERT INTO geonames_search (geonames_search) VALUES ('optimize')")
+
+def create_spatial_index(cursor):
+    """ Create the R*Tree index, see [CREATE_SPATIAL_INDEX] """
+    cursor.execute('CREATE VIRTUAL TABLE geonames_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon, +feature_class)')
+    cursor.execute('INSERT INTO geonames_rtree SELECT geonames_id, latitude, latitude, longitude, longitude, feature_class FROM geonames')
+
+def spatial_index_update(cursor, geonames_id):
+    """ Add, update, or remove ([geonames_id] no longer exists) a place in the R*Tree index """
+    cursor.execute('DELETE FROM geonames_rtree WHERE id = ?', (geonames_id,))
+    cursor.execute("""
+        INSERT INTO geonames_rtree
+        SELECT geonames_id, latitude, latitude, longitude, longitude, feature_class
+        FROM geonames
+        WHERE geonames_id = ?
+    """, (geonames_id,))
+
+def search_index_remove(cursor, geonames_id):
+    """
+    Remove a place from the search index before it is changed or deleted by
+    [update()]. Returns the rank of the place or [None] if it does not exist.
+    A contentless FTS5 table requires the current values to delete a record.
+    """
+    row = cursor.execute("""
+        SELECT r.rank, g.name, g.ascii_name, {1}, g.country_code
+        FROM geonames g
+        INNER JOIN geonames_search_rank r ON r.geonames_id = g.geonames_id
+        {0}
+        WHERE g.geonames_id = ?
+    """.format(*alternate_names_join()), (geonames_id,)).fetchone()
+    if row is None:
+        return None
+    cursor.execute("INSERT INTO geonames_search (geonames_search, rowid, name, ascii_name, alternate_names, country_code) VALUES ('delete', ?, ?, ?, ?, ?)", row)
+    return row[0]
+
+def search_index_add(cursor, geonames_id, rank=None):
+    """ Add a place to the search index, new places are ranked after all existing places """
+    if rank is None:
+        cursor.execute('INSERT INTO geonames_search_rank (geonames_id) VALUES (?)', (geonames_id,))
+        rank = cursor.lastrowid
+    cursor.execute("""
+        INSERT INTO geonames_search (rowid, name, ascii_name, alternate_names, country_code)
+        SELECT ?, g.name, g.ascii_name, {1}, g.country_code
+        FROM geonames g
+        {0}
+        WHERE g.geonames_id = ?
+    """.format(*alternate_names_join()), (rank, geonames_id))
+
+def report_database(cursor):
+    """
+    Print the file size and the number of [geonames] rows stored in each page.
+    Queries read whole pages so more rows per page means fewer page reads and
+    more rows held in the same amount of page cache. For the compact schema
+    the rows per page with [alternate_names] stored inline is estimated from
+    the size of [geonames_alternate_names].
+    """
+    print('Database Size: {0:,.1f} MB'.format(os.path.getsize(SQLITE_FILE) / 1024 / 1024))
+    try:
+        sql = "SELECT SUM(pgsize), SUM(CASE WHEN pagetype = 'leaf' THEN ncell END) FROM dbstat WHERE name = ?"
+        table_bytes, rows = cursor.execute(sql, ('geonames',)).fetchone()
+        page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+    except sqlite3.OperationalError:
+        # SQLite was built without the [dbstat] virtual table
+        return
+    rows_per_page = rows / (table_bytes / page_size)
+    print('Table [geonames]: {0:,.1f} MB, {1:.1f} Rows per Page'.format(table_bytes / 1024 / 1024, rows_per_page))
+    if COMPACT_SCHEMA:
+        names_bytes = cursor.execute('SELECT SUM(pgsize) FROM dbstat WHERE name = ?', ('geonames_alternate_names',)).fetchone()[0] or 0
+        inline_rows_per_page = rows / ((table_bytes + names_bytes) / page_size)
+        print('Table [geonames_alternate_names]: {0:,.1f} MB'.format(names_bytes / 1024 / 1024))
+        print('Page Cache: {0:.1f}x more [geonames] rows per cached page than with [alternate_names] inline (est. {1:.1f} Rows per Page)'.format(
+            rows_per_page / inline_rows_per_page, inline_rows_per_page))
+
+def read_sql(file_name):
+    with open(os.path.join(SQL_DIR, file_name), encoding='utf-8') as f:
+        return f.read()
+
+def query_records(cursor, sql, params=()):
+    """ Return rows as a list of dicts, the same format as the PHP routes """
+    cursor.execute(sql, params)
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def write_snapshot(snapshot_dir, manifest, route, file_name, data):
+    """ Save a compressed JSON file and add it to the manifest """
+    content = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    compressed = gzip.compress(content, compresslevel=9, mtime=0)
+    path = os.path.join(snapshot_dir, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(compressed)
+    manifest[route] = {
+        'file': file_name,
+        'etag': hashlib.md5(compressed).hexdigest(),
+        'bytes': len(content),
+        'gzip_bytes': len(compressed),
+    }
+
+def create_snapshots(cursor):
+    """
+    Save snapshots to a new directory that then replaces [SNAPSHOT_DIR] so
+    the web server never reads a partial set of files. Countries and regions
+    with codes that are not safe for file names are skipped and are queried
+    from the database by the web server.
+    """
+    safe_code = re.compile(r'^[A-Za-z0-9_-]+$')
+    start_time = time.time()
+    new_dir = SNAPSHOT_DIR + '.new'
+    shutil.rmtree(new_dir, ignore_errors=True)
+    manifest = {}
+
+    # Countries, [order_by=country] is handled the same as [Geonames::getCountries()]
+    sql = read_sql('geonames-countries.sql')
+    countries = query_records(cursor, sql)
+    write_snapshot(new_dir, manifest, '/data/geonames/countries', 'countries.json.gz', {'countries': countries})
+    records = query_records(cursor, sql.replace('population DESC,', ''))
+    write_snapshot(new_dir, manifest, '/data/geonames/countries?order_by=country', 'countries-by-country.json.gz', {'countries': records})
+
+    # Regions and the 20 largest cities of each region
+    regions_sql = read_sql('geonames-admin1-by-country.sql')
+    cities_sql = read_sql('geonames-20-largest-cities-in-admin1.sql')
+    for country in countries:
+        country = country['iso']
+        if not safe_code.match(country or ''):
+            continue
+        regions = query_records(cursor, regions_sql, (country,))
+        write_snapshot(new_dir, manifest, '/data/geonames/regions/' + country, 'regions/{0}.json.gz'.format(country), {'regions': regions})
+        for region in sorted(set(region['admin1_code'] or '' for region in regions)):
+            if not safe_code.match(region):
+                continue
+            records = query_records(cursor, cities_sql, (country, region))
+            route = '/data/geonames/cities/{0}/{1}'.format(country, region)
+            write_snapshot(new_dir, manifest, route, 'cities/{0}/{1}.json.gz'.format(country, region), {'cities': records})
+
+    # Replace the previous snapshots
+    with open(os.path.join(new_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'created_at': datetime.now().isoformat(timespec='seconds'), 'files': manifest}, indent=4))
+    old_dir = SNAPSHOT_DIR + '.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.isdir(SNAPSHOT_DIR):
+        os.rename(SNAPSHOT_DIR, old_dir)
+    os.rename(new_dir, SNAPSHOT_DIR)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    size = sum(item['gzip_bytes'] for item in manifest.values())
+    print('Created {0:,} Snapshots ({1:,.1f} MB) in {2:.2f} seconds'.format(len(manifest), size / 1024 / 1024, time.time() - start_time))
+
+def remove_snapshots():
+    """ Delete [SNAPSHOT_DIR] when the database changes and snapshots are not created """
+    if os.path.isdir(SNAPSHOT_DIR):
+        shutil.rmtree(SNAPSHOT_DIR)
+        print('Deleted Snapshots [{0}], set [CREATE_SNAPSHOTS = True] to create them'.format(SNAPSHOT_DIR))
+    for path in [SNAPSHOT_DIR + '.new', SNAPSHOT_DIR + '.old']:
+        shutil.rmtree(path, ignore_errors=True)
+
+def snapshots():
+    """ Create snapshots from an existing database, [python3 geonames.py snapshots] """
+    if not os.path.isfile(SQLITE_FILE):
+        print('Error - File [{0}] does not exist, run a full import first'.format(SQLITE_FILE))
+        return
+    db = sqlite3.connect('file:{0}?mode=ro'.format(SQLITE_FILE), uri=True)
+    cursor = db.cursor()
+    create_snapshots(cursor)
+    cursor.close()
+    db.close()
+
+def updates_table_sql():
+    """ Table of files that have been imported or applied to the database """
+    return """
+        CREATE TABLE IF NOT EXISTS geonames_updates (
+            file_name TEXT PRIMARY KEY,
+            file_type TEXT,
+            file_date TEXT,
+            applied_at TEXT,
+            upserted INT,
+            deleted INT
+        )
+    """
+
+def update_files():
+    """ Return a sorted list of (date, file type, file name) for change files in [UPDATES_DIR] """
+    files = []
+    for name in os.listdir(UPDATES_DIR):
+        match = UPDATE_FILE_PATTERN.match(name)
+        if match:
+            file_type, file_date = match.groups()
+            files.append((file_date, UPDATE_FILE_TYPES.index(file_type), file_type, name))
+    return [(file_date, file_type, name) for file_date, _, file_type, name in sorted(files)]
+
+def update_file_rows(path):
+    """ Read records from a change file, same format as the other Geonames files """
     with open(path, encoding='utf-8') as f:
         for line in f:
             line = line.rstrip('\n')
-            if line != '':
-                values = line.split('\t')
-                record_count += 1
-                yield values
+            if line != '' and not line.startswith('#'):
+                yield line.split('\t')
+
+def set_alternate_names(cursor, geonames_id, alternate_names):
+    """ Save [alternate_names] for a place that exists in [geonames] """
+    if not COMPACT_SCHEMA:
+        cursor.execute('UPDATE geonames SET alternate_names = ? WHERE geonames_id = ?', (alternate_names, geonames_id))
+    elif alternate_names:
+        cursor.execute("""
+            INSERT INTO geonames_alternate_names (geonames_id, alternate_names) VALUES (?, ?)
+            ON CONFLICT (geonames_id) DO UPDATE SET alternate_names = excluded.alternate_names
+        """, (geonames_id, alternate_names))
+    else:
+        cursor.execute('DELETE FROM geonames_alternate_names WHERE geonames_id = ?', (geonames_id,))
+
+def update_alternate_names(cursor, geonames_id, add=None, remove=None, search_index=False):
+    """ Add or remove a name from the comma-separated [alternate_names] column """
+    sql = 'SELECT {1} FROM geonames g {0} WHERE g.geonames_id = ?'.format(*alternate_names_join())
+    row = cursor.execute(sql, (geonames_id,)).fetchone()
+    if row is None:
+        return 0
+    names = row[0].split(',') if row[0] else []
+    if add is not None and add not in names:
+        names.append(add)
+    elif remove is not None and remove in names:
+        names.remove(remove)
+    else:
+        return 0
+    rank = search_index_remove(cursor, geonames_id) if search_index else None
+    set_alternate_names(cursor, geonames_id, ','.join(names))
+    if search_index:
+        search_index_add(cursor, geonames_id, rank)
+    return 1
+
+def apply_update_file(cursor, file_type, path, search_index=False, spatial_index=False):
+    """
+    Apply a single change file, returns (upserted, deleted) counts. When [search_index]
+    or [spatial_index] is [True] the full-text search or R*Tree index is also updated.
+    """
+    upserted = 0
+    deleted = 0
+    if file_type == 'modifications':
+        columns = (COMPACT_COLUMNS if COMPACT_SCHEMA else GEONAMES_COLUMNS)
+        sql = 'INSERT INTO geonames ({0}) VALUES ({1}) ON CONFLICT (geonames_id) DO UPDATE SET {2}'.format(
+            ', '.join(columns),
+            ', '.join('?' for _ in columns),
+            ', '.join('{0} = excluded.{0}'.format(column) for column in columns[1:]))
+        for values in update_file_rows(path):
+            rank = search_index_remove(cursor, values[0]) if search_index else None
+            if COMPACT_SCHEMA:
+                row = dict(zip(GEONAMES_COLUMNS, values))
+                cursor.execute(sql, [row[column] for column in columns])
+                set_alternate_names(cursor, values[0], row['alternate_names'])
+            else:
+                cursor.execute(sql, values)
+            if search_index:
+                search_index_add(cursor, values[0], rank)
+            if spatial_index:
+                spatial_index_update(cursor, values[0])
+            upserted += 1
+    elif file_type == 'deletes':
+        # geonameid, name, comment
+        for values in update_file_rows(path):
+            if search_index and search_index_remove(cursor, values[0]) is not None:
+                cursor.execute('DELETE FROM geonames_search_rank WHERE geonames_id = ?', (values[0],))
+            cursor.execute('DELETE FROM geonames WHERE geonames_id = ?', (values[0],))
+            deleted += cursor.rowcount
+            if COMPACT_SCHEMA:
+                cursor.execute('DELETE FROM geonames_alternate_names WHERE geonames_id = ?', (values[0],))
+            if spatial_index:
+                spatial_index_update(cursor, values[0])
+    elif file_type == 'alternateNamesModifications':
+        # alternateNameId, geonameid, isolanguage, alternate name, isPreferredName, ...
+        for values in update_file_rows(path):
+            if values[2] not in SKIP_ALTERNATE_NAME_TYPES:
+                upserted += update_alternate_names(cursor, values[1], add=values[3], search_index=search_index)
+    elif file_type == 'alternateNamesDeletes':
+        # alternateNameId, geonameid, name, comment
+        for values in update_file_rows(path):
+            deleted += update_alternate_names(cursor, values[1], remove=values[2], search_index=search_index)
+    return upserted, deleted
+
+def update():
+    """
+    Apply daily change files from [UPDATES_DIR] to an existing database.
+    See comments at the top of this file.
+    """
+    if not os.path.isfile(SQLITE_FILE):
+        print('Error - File [{0}] does not exist, run a full import first'.format(SQLITE_FILE))
+        return
+
+    # WAL mode allows the site to read from the database during the update
+    db = sqlite3.connect(SQLITE_FILE, timeout=60)
+    cursor = db.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute(updates_table_sql())
+    db.commit()
+    applied = set(row[0] for row in cursor.execute('SELECT file_name FROM geonames_updates'))
+    import_date = cursor.execute("SELECT MAX(file_date) FROM geonames_updates WHERE file_type = 'import'").fetchone()[0]
+    search_index = has_table(cursor, 'geonames_search')
+    spatial_index = has_table(cursor, 'geonames_rtree')
+
+    # Use the layout of the existing database rather than the [COMPACT_SCHEMA] option
+    global COMPACT_SCHEMA
+    COMPACT_SCHEMA = has_table(cursor, 'geonames_alternate_names')
+
+    # Apply each file in a single transaction along with the record that it was applied
+    files = [(file_date, file_type, name) for file_date, file_type, name in update_files()
+             if name not in applied and (import_date is None or file_date >= import_date)]
+    if files and not CREATE_SNAPSHOTS:
+        remove_snapshots()
+    file_count = 0
+    for file_date, file_type, name in files:
+        start_time = time.time()
+        upserted, deleted = apply_update_file(cursor, file_type, os.path.join(UPDATES_DIR, name), search_index, spatial_index)
+        now = datetime.now().isoformat(timespec='seconds')
+        cursor.execute('INSERT INTO geonames_updates VALUES (?, ?, ?, ?, ?, ?)', (name, file_type, file_date, now, upserted, deleted))
+        db.commit()
+        file_count += 1
+        print('Applied [{0}]: {1} Updated, {2} Deleted in {3:.2f} seconds'.format(name, upserted, deleted, time.time() - start_time))
+
+    if RUN_ANALYZE and file_count > 0:
+        cursor.execute('PRAGMA optimize')
+    if CREATE_SNAPSHOTS and file_count > 0:
+        create_snapshots(cursor)
+    cursor.close()
+    db.close()
+    print('Success {0} Update Files Applied'.format(file_count))
 
 def main():
     """
@@ -88,15 +823,24 @@ def main():
     # Does the SQLite File already exist? Exit or delete based on option
     if RECREATE_SQLITE_DB and os.path.isfile(SQLITE_FILE):
         os.remove(SQLITE_FILE)
+        # WAL files from [update()] are kept while the site has the database
+        # open and would otherwise be read as part of the new database
+        for path in [SQLITE_FILE + '-wal', SQLITE_FILE + '-shm']:
+            if os.path.isfile(path):
+                os.remove(path)
     if os.path.isfile(SQLITE_FILE):
         print('Error - File [{0}] already exists'.format(SQLITE_FILE))
         return
+    if not CREATE_SNAPSHOTS:
+        remove_snapshots()
 
     # Connect to Db and Create Tables
     db = sqlite3.connect(SQLITE_FILE)
     cursor = db.cursor()
     cursor.execute('PRAGMA synchronous = OFF')
     cursor.execute('PRAGMA journal_mode = MEMORY')
+    if PAGE_SIZE is not None:
+        cursor.execute('PRAGMA page_size = {0:d}'.format(PAGE_SIZE))
     cursor.execute("""
         CREATE TABLE countries (
             iso TEXT,
@@ -120,29 +864,13 @@ def main():
             equivalent_fips_code TEXT
         )
     """)
-    cursor.execute("""
-        CREATE TABLE geonames (
-            geonames_id INT PRIMARY KEY,
-            name TEXT COLLATE NOCASE,
-            ascii_name TEXT,
-            alternate_names TEXT,
-            latitude DOUBLE,
-            longitude DOUBLE,
-            feature_class TEXT,
-            feature_code TEXT,
-            country_code TEXT,
-            cc2 TEXT,
-            admin1_code TEXT,
-            admin2_code TEXT,
-            admin3_code TEXT,
-            admin4_code TEXT,
-            population LONG,
-            elevation INT,
-            dem INT,
-            timezone TEXT,
-            modification_date TEXT
-        )
-    """)
+    if COMPACT_SCHEMA:
+        for sql in compact_tables_sql():
+            cursor.execute(sql)
+    else:
+        cursor.execute(geonames_table_sql())
+    if INDEX_MODE == 'during':
+        create_indexes(cursor)
 
     # Insert Records for [countries] Table
     sql = 'INSERT INTO countries (iso, iso3, iso_numeric, fips, country, capital, area_km, population, continent, tld, currency_code, currency_name, phone, postal_code_format, postal_code_regex, languages, geoname_id, neighbours, equivalent_fips_code) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
@@ -150,17 +878,45 @@ def main():
     print('Added {0} Records to [countries] Table'.format(record_count))
 
     # Insert Records for [geonames] Table
-    sql = 'INSERT INTO geonames (geonames_id, name, ascii_name, alternate_names, latitude, longitude, feature_class, feature_code, country_code, cc2, admin1_code, admin2_code, admin3_code, admin4_code, population, elevation, dem, timezone, modification_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-    cursor.executemany(sql, places_generator())
+    import_places(db)
     print('Added {0} Records to [geonames] Table'.format(record_count))
 
     # Add Indexes
-    cursor.execute('CREATE INDEX country_feature ON geonames (country_code, feature_class, feature_code)')
-    cursor.execute('CREATE INDEX country_admin1_feature ON geonames (country_code, admin1_code, feature_class, feature_code)')
-    cursor.execute('CREATE INDEX place_names ON geonames (name , country_code, feature_class, feature_code, population)')
+    if INDEX_MODE == 'after':
+        create_indexes(cursor)
+
+    # Add Full-text Search Index
+    if CREATE_SEARCH_INDEX:
+        create_search_index(cursor)
+        print('Created Full-text Search Index')
+
+    # Add Spatial Index
+    if CREATE_SPATIAL_INDEX:
+        create_spatial_index(cursor)
+        print('Created Spatial Index')
+
+    # Save the date of the import file so older change files are skipped by [update()]
+    path, _ = data_file(PLACES_FILE)
+    file_date = datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d')
+    cursor.execute(updates_table_sql())
+    cursor.execute('INSERT INTO geonames_updates VALUES (?, ?, ?, ?, ?, ?)', (os.path.basename(path), 'import', file_date, datetime.now().isoformat(timespec='seconds'), record_count, 0))
 
     # Commit Transactions
     db.commit()
+
+    # Update Query Planner Statistics and Rebuild
+    if RUN_ANALYZE:
+        cursor.execute('ANALYZE')
+        db.commit()
+        print('Analyzed Tables and Indexes')
+    if RUN_VACUUM:
+        cursor.execute('VACUUM')
+        print('Vacuumed Database')
+    report_database(cursor)
+
+    # Save JSON Files for the Web Server
+    if CREATE_SNAPSHOTS:
+        create_snapshots(cursor)
     cursor.close()
     db.close()
     print('Success Database Created')
@@ -169,4 +925,9 @@ def main():
 # Start of Script
 #-------------------------------------------------
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'update':
+        update()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'snapshots':
+        snapshots()
+    else:
+        main()